@@ -0,0 +1,388 @@
+#!/usr/bin/env python3
+"""
+An asyncio counterpart to clarity.Clarity, for use from asyncio services or to overlap many independent lookups without
+a thread per request.
+
+    clarity = await AsyncClarity.connect(root, user, password)
+    container = await clarity.get_object(clarity.root + 'containers/27-12105')
+    samples = await (await container.get('placement')).get('sample')
+
+It uses the same caches as Clarity (ElementCache, and DiskCache when given one), batches artifacts, containers, files and
+samples in the same way, and never has more than max_concurrency requests in flight at once (fewer when the server is
+struggling, and failed requests are retried, see governor). Navigation is through
+AsyncClarityElement, where get, get_first and get_udf are coroutines as they may have to download the linked objects.
+
+HTTP is spoken directly over asyncio streams with keep-alive connections, using transport's basic auth header and
+gzip/deflate decompression as transport.PooledOpener does. A request that is cancelled (such as the prefetch of the
+next page when iter_search is stopped) closes its connection, as it may have part of a response left on it. Requests,
+batches and cache lookups are recorded in clarity.metrics, as for Clarity.
+"""
+import asyncio
+import http.client
+import io
+import logging
+import time
+from collections import defaultdict
+from urllib.error import HTTPError, URLError
+from urllib.parse import urlsplit
+from xml.etree import ElementTree
+
+from cache import ElementCache, udf_map
+from clarity import (BATCHABLE, BATCH_SIZE, MAX_RETRIES, ClarityCache, ClarityElement, ClarityException, details_xml,
+                     exit_metrics, links_xml, page_links, to_columns)
+from governor import RETRYABLE_ERRORS, Governor, is_idempotent
+from metrics import Metrics, endpoint
+from transport import ACCEPT_ENCODING, STALE_CONNECTION_ERRORS, basic_authorization, decompress
+
+__author__ = 'rf9'
+
+logger = logging.getLogger(__name__)
+
+MAX_CONCURRENCY = 16
+# A connection closed by the server shows up as a short read here, rather than as http.client.RemoteDisconnected.
+ASYNC_STALE_CONNECTION_ERRORS = STALE_CONNECTION_ERRORS + (asyncio.IncompleteReadError,)
+
+
+class _Connection:
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+
+    def close(self):
+        self.writer.close()
+
+
+class AsyncClarity(ClarityCache):
+    def __init__(self, root, user, password, max_concurrency=MAX_CONCURRENCY, batch_size=BATCH_SIZE, cache=None,
+                 disk_cache=None, metrics=None, max_retries=MAX_RETRIES, governor=None):
+        if root[-1] != '/':
+            root += "/"
+        self.root = root
+        self.batch_size = batch_size
+        self.cache = cache if cache is not None else ElementCache(object_type=self._object_type)
+        self.disk_cache = disk_cache
+        if metrics is None:
+            metrics = exit_metrics() or Metrics()
+        self.metrics = metrics
+
+        self._authorization = basic_authorization(user, password)
+        if governor is None:
+            governor = Governor(max_limit=max_concurrency, max_retries=max_retries, metrics=metrics)
+        self.governor = governor
+        # Notified whenever a request gives its place back to the governor.
+        self._released = asyncio.Condition()
+        self._idle = defaultdict(list)
+
+    @classmethod
+    async def connect(cls, root, user, password, **kwargs):
+        # Create a client and check the credentials, as Clarity does when it is constructed.
+        clarity = cls(root, user, password, **kwargs)
+        try:
+            await clarity._request('GET', clarity.root)
+        except HTTPError as err:
+            await clarity.close()
+            if err.msg == "Unauthorized":
+                raise ClarityException("Invalid username or password")
+            raise ClarityException("Invalid root uri")
+        return clarity
+
+    async def close(self):
+        idle, self._idle = self._idle, defaultdict(list)
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def get_xml(self, uri_list, use_cache=True):
+        # Allow to be called with a single uri and return a single element (Not in list)
+        if isinstance(uri_list, str):
+            return (await self.get_xml([uri_list], use_cache))[0]
+
+        elements, partitioned_uris, stale_entries = self._from_cache(uri_list, use_cache)
+
+        requests = []
+        for object_type, uris in partitioned_uris.items():
+            if object_type in BATCHABLE:
+                requests.append(self.batch_get(uris, object_type))
+            else:
+                requests += [self._single_get_xml(uri, stale_entries.get(uri)) for uri in uris]
+
+        for result in await asyncio.gather(*requests):
+            if isinstance(result, list):
+                elements += result
+            else:
+                elements.append(result)
+
+        return elements
+
+    async def _single_get_xml(self, uri, stale_entry=None):
+        logger.info('Downloading %s', uri)
+        try:
+            status, headers, data = await self._request('GET', uri, headers=self._conditional_headers(stale_entry))
+        except HTTPError as err:
+            if err.code != 304 or stale_entry is None:
+                raise
+            return self._cache_revalidated(uri, stale_entry)
+
+        return self._cache_downloaded(uri, data, headers.get('ETag'), headers.get('Last-Modified'))
+
+    async def batch_get(self, uri_list, object_type):
+        # Batch retrieve the uris, in chunks of batch_size that are all sent at once.
+        chunks = [uri_list[i:i + self.batch_size] for i in range(0, len(uri_list), self.batch_size)]
+        results = await asyncio.gather(*[self._batch_retrieve(chunk, object_type) for chunk in chunks])
+        return [element for elements in results for element in elements]
+
+    async def _batch_retrieve(self, uri_list, object_type):
+        logger.info('Downloading %d %s', len(uri_list), object_type)
+        self.metrics.record_batch('retrieve', object_type, len(uri_list))
+        status, headers, data = await self._request('POST', self.root + object_type + '/batch/retrieve',
+                                                     links_xml(uri_list, object_type))
+        return list(self._cache_retrieved(ElementTree.fromstring(data), uri_list, object_type))
+
+    async def batch_post_xml(self, object_type, xml_list):
+        if object_type not in BATCHABLE:
+            raise ClarityException("Cannot batch %r" % object_type)
+
+        xml_list = list(xml_list)
+        chunks = [xml_list[i:i + self.batch_size] for i in range(0, len(xml_list), self.batch_size)]
+        results = await asyncio.gather(*[self._batch_update(chunk, object_type) for chunk in chunks])
+        return [link for links in results for link in links]
+
+    async def _batch_update(self, xml_list, object_type):
+        logger.info('Updating %d %s', len(xml_list), object_type)
+        self.metrics.record_batch('update', object_type, len(xml_list))
+        status, headers, data = await self._request('POST', self.root + object_type + '/batch/update',
+                                                     details_xml(xml_list))
+
+        self._cache_updated(xml_list)
+        return list(ElementTree.fromstring(data))
+
+    async def iter_search(self, uri, resolve=False, follow='next-page'):
+        # Asynchronously yield every link from a paged list or search uri, downloading the following page while the
+        # current one is being used. With resolve=True the linked objects are yielded instead of the links.
+        visited = {uri}
+        next_page = asyncio.ensure_future(self._get_page(uri))
+
+        while next_page is not None:
+            page = await next_page
+
+            next_link = page.find(follow)
+            next_uri = next_link.get('uri') if next_link is not None else None
+            if next_uri is None or next_uri in visited:
+                next_page = None
+            else:
+                visited.add(next_uri)
+                next_page = asyncio.ensure_future(self._get_page(next_uri))
+
+            try:
+                links = page_links(page)
+                if resolve:
+                    for element in await self.get_xml([link.get('uri') for link in links if link.get('uri')]):
+                        yield element
+                else:
+                    for link in links:
+                        yield link
+            except BaseException:
+                if next_page is not None:
+                    next_page.cancel()
+                raise
+
+    async def _get_page(self, uri):
+        # Pages of search results are not cached, as their contents change as objects are created.
+        logger.info('Downloading %s', uri)
+        status, headers, data = await self._request('GET', uri)
+        return ElementTree.fromstring(data)
+
+    async def get_object(self, uri):
+        return AsyncClarityElement(self, [await self.get_xml(uri)])
+
+    async def prefetch(self, xml_list, path):
+        # Download everything along path from the elements in xml_list a level at a time, as Clarity.prefetch does.
+        current = list(xml_list)
+
+        for tag in path.strip('/').split('/'):
+            current = await self._resolve_links(current, tag)
+            current = [child for element in current for child in element.findall(tag)]
+
+        return await self._resolve_links(current)
+
+    async def _resolve_links(self, xml_list, tag=None):
+        # Replace the elements that are only links (they have a uri, but not the child tag) with the linked objects.
+        links = self._link_uris(xml_list, tag)
+        return self._replace_links(xml_list, await self.get_xml(links), tag) if links else xml_list
+
+    async def _request(self, method, url, body=None, headers=None):
+        # Make a request, retrying it (if it is idempotent) when it fails in a way that may not happen again.
+        attempt = 0
+        while True:
+            try:
+                return await self._request_once(method, url, body, headers)
+            except RETRYABLE_ERRORS as err:
+                delay = self.governor.retry_delay(err, attempt, is_idempotent(method, url))
+                if delay is None:
+                    raise
+                logger.warning('Retrying %s %s in %.1fs after error: %s', method, url, delay, err)
+                await asyncio.sleep(delay)
+                attempt += 1
+
+    async def _acquire_place(self):
+        async with self._released:
+            while True:
+                place = self.governor.try_acquire()
+                if place is not None:
+                    return place
+                await self._released.wait()
+
+    async def _release_place(self, place, endpoint_name, status, seconds, batch):
+        # A status of None gives the place back without it counting as a response, for a cancelled request.
+        if status is None:
+            self.governor.abandon(place)
+        else:
+            self.governor.release(place, endpoint_name, status, seconds, batch)
+        async with self._released:
+            self._released.notify_all()
+
+    async def _request_once(self, method, url, body=None, headers=None):
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+
+        head = ['%s %s HTTP/1.1' % (method, path),
+                'Host: %s' % parts.netloc,
+                'Authorization: %s' % self._authorization,
+                'Accept-Encoding: %s' % ACCEPT_ENCODING]
+        head += ['%s: %s' % header for header in (headers or {}).items()]
+        if body is not None:
+            head += ['Content-Type: application/xml', 'Content-Length: %d' % len(body)]
+        message = ('\r\n'.join(head) + '\r\n\r\n').encode('latin-1') + (body or b'')
+
+        endpoint_name, object_type = endpoint(self.root, url)
+
+        place = await self._acquire_place()
+        start = time.monotonic()
+        status = 'error'
+        try:
+            while True:
+                connection, reused = await self._acquire(key)
+                try:
+                    connection.writer.write(message)
+                    await connection.writer.drain()
+                    status, reason, headers, data, keep_alive = await self._read_response(connection.reader)
+                    break
+                except (ASYNC_STALE_CONNECTION_ERRORS + (OSError,)) as err:
+                    connection.close()
+                    # The server closed the idle connection, so try again on a new one.
+                    if reused and isinstance(err, ASYNC_STALE_CONNECTION_ERRORS):
+                        continue
+                    self.metrics.record_request(method, endpoint_name, object_type, 'error', time.monotonic() - start,
+                                                len(body or b''))
+                    raise URLError(err)
+                except BaseException as err:
+                    # Cancelled (or failed) part way through, so the connection may have an unread response on it.
+                    connection.close()
+                    if isinstance(err, asyncio.CancelledError):
+                        status = None
+                    raise
+        finally:
+            await self._release_place(place, endpoint_name, status, time.monotonic() - start, body is not None)
+
+        self.metrics.record_request(method, endpoint_name, object_type, status, time.monotonic() - start,
+                                    len(body or b''), len(data))
+
+        if keep_alive:
+            self._idle[key].append(connection)
+        else:
+            connection.close()
+
+        data = decompress(data, headers.get('Content-Encoding'))
+
+        if status >= 300:
+            raise HTTPError(url, status, reason, headers, io.BytesIO(data))
+
+        return status, headers, data
+
+    async def _acquire(self, key):
+        if self._idle[key]:
+            return self._idle[key].pop(), True
+
+        scheme, netloc = key
+        host, _, port = netloc.partition(':')
+        port = int(port) if port else (443 if scheme == 'https' else 80)
+        reader, writer = await asyncio.open_connection(host, port, ssl=(scheme == 'https') or None)
+        return _Connection(reader, writer), False
+
+    @staticmethod
+    async def _read_response(reader):
+        status_line = await reader.readuntil(b'\r\n')
+        version, status, reason = (status_line.decode('latin-1').rstrip('\r\n').split(' ', 2) + [''])[:3]
+        header_lines = [await reader.readuntil(b'\r\n')]
+        while header_lines[-1] != b'\r\n':
+            header_lines.append(await reader.readuntil(b'\r\n'))
+        headers = http.client.parse_headers(io.BytesIO(b''.join(header_lines)))
+
+        keep_alive = version == 'HTTP/1.1' and (headers.get('Connection') or '').lower() != 'close'
+
+        if (headers.get('Transfer-Encoding') or '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int((await reader.readuntil(b'\r\n')).split(b';')[0], 16)
+                if size == 0:
+                    # Skip any trailers, up to the blank line that ends the response.
+                    while await reader.readuntil(b'\r\n') != b'\r\n':
+                        pass
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readexactly(2)
+            data = b''.join(chunks)
+        elif headers.get('Content-Length') is not None:
+            data = await reader.readexactly(int(headers['Content-Length']))
+        elif int(status) in (204, 304):
+            data = b''
+        else:
+            data = await reader.read()
+            keep_alive = False
+
+        return int(status), reason, headers, data, keep_alive
+
+
+class AsyncClarityElement(ClarityElement):
+    async def get(self, item, first=True):
+        value = self._get_local(item)
+        if value is not None:
+            return value
+
+        # If it has a url, fetch the urls and try with the fetched objects.
+        uris = self._uris()
+        if uris and first:
+            return await AsyncClarityElement(self.clarity, await self.clarity.get_xml(uris)).get(item, first=False)
+
+        return []
+
+    async def get_first(self, item):
+        values = await self.get(item)
+        return values[0] if values else None
+
+    async def prefetch(self, path):
+        # Download every object along path (e.g. 'placement/sample/project') in one batch per level.
+        await self.clarity.prefetch(self.xml_list, path)
+        return self
+
+    async def get_udf(self, name):
+        xml_list = self.xml_list
+
+        # If none of the elements have any UDFs and they have urls, fetch the urls and use the fetched objects.
+        if not any(udf_map(xml) for xml in xml_list) and self._uris():
+            xml_list = await self.clarity.get_xml(self._uris())
+
+        return AsyncClarityElement(self.clarity, [field for xml in xml_list for field in udf_map(xml).get(name, ())])
+
+    async def to_columns(self, fields):
+        # Extract several fields from every element in one pass. See clarity.to_columns.
+        return to_columns(await self.clarity._resolve_links(self.xml_list), fields)
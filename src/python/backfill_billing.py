@@ -23,7 +23,7 @@ if __name__ == "__main__":
                               ('Post Capture Library Pooling', 'charging_library_construction'),
                               ('Sequencing Data Manual QC (NPG)', 'charging_sequencing')]:
             step = step.replace(' ', '%20')
-            processes = clarity.get_object(clarity.root + 'processes?type=' + step).find('process').get('uri')
+            processes = [link.get('uri') for link in clarity.iter_search(clarity.root + 'processes?type=' + step)]
 
             for process in processes:
                 string = 'epp --action queue_message --routing_key event --purpose %s --process_url %s --step_url %s'
@@ -1,9 +1,28 @@
 #!/usr/bin/env python3
+"""
+Set the library concentration and molarity of samples from Caliper plate reader csv files.
 
+usage: python backfill_caliper.py [--dry-run] [--index=<index_file>] <root_uri> [<file or directory> ...]
+
+Every csv file in the directories given (backfill2 next to this script by default) is read, a line at a time. The plate
+signature is the second part of each file name (split on '_'). The containers with the signatures are looked up in
+the local signature index when one is given (see signature_index, it is brought up to date first), and the ones that are
+not in it are found with batched searches, PLATES_PER_SEARCH files at a time. Their artifacts are downloaded in batches
+too. The samples are downloaded afresh just before they are changed, only the values that differ from the ones already
+on them are changed, and the changed samples are sent as concurrent batch updates (see udf_update).
+
+With --dry-run nothing is changed, but every change that would be made and the number of requests it would take are
+printed.
+"""
+
+import itertools
 import os
-from xml.etree import ElementTree
 import sys
+
+from cache import udf_map
 from clarity import Clarity
+from signature_index import SIGNATURE, SignatureIndex
+from udf_update import UdfUpdater
 
 __author__ = 'rf9'
 
@@ -11,9 +30,9 @@ DIRECTORY_NAME = "backfill2"
 FILE_DIR = os.path.dirname(os.path.realpath(__file__))
 CONCENTRATION = "WTSI Library Concentration"
 MOLARITY = "WTSI Library Molarity"
-FIELD = "{http://genologics.com/ri/userdefined}field"
 CONCENTRATION_COLUMN_HEADER = 'Total Conc. (ng/ul)'
 MOLARITY_COLUMN_HEADER = 'Region[200-700] Molarity (nmol/l)'
+PLATES_PER_SEARCH = 200
 
 
 def get_rows(file):
@@ -22,83 +41,113 @@ def get_rows(file):
         yield {header: cell.strip() for (header, cell) in zip(headers, line.split(',')) if cell.strip()}
 
 
-def change_xml(xml, field_name, value):
-    for field in sample_xml.findall(FIELD):
-        if field.get("name") == field_name:
-            field.text = value
-            break
-    else:
-        builder = ElementTree.TreeBuilder()
-        builder.start(FIELD, {
-            "type": "String",
-            "name": field_name
-        })
-        element = builder.close()
-        element.text = value
+def iter_files(paths):
+    for path in paths:
+        if os.path.isfile(path):
+            yield path
+        for (directory, subdirectories, filenames) in os.walk(path):
+            for filename in sorted(filenames):
+                yield os.path.join(directory, filename)
 
-        xml.append(element)
 
+def read_plate(path):
+    # Returns the signature of the plate and a dictionary of well to the UDF values for the sample in it.
+    signature = os.path.basename(path).split("_")[1]
+    # '/' can not be in a file name, so is written as 'l'.
+    signature = signature.replace('l', '/')
 
-if __name__ == '__main__':
-    if len(sys.argv) == 2:
-        root_url = sys.argv[1]
-    else:
-        sys.stderr.write("usage: python backfill_caliper.py <root_uri>\n")
-        sys.exit(1)
+    molarities = {}
+    concentrations = {}
+    with open(path) as file:
+        for row in get_rows(file):
+            well = row['Sample Name'].split("_")[0]
 
-    clarity = Clarity(root_url)
+            if MOLARITY_COLUMN_HEADER in row:
+                molarity = float(row[MOLARITY_COLUMN_HEADER]) * 5
+
+                if well not in molarities:
+                    molarities[well] = molarity
+                else:
+                    molarities[well] = (molarities[well] + molarity) / 2
 
-    for (directory, subdirectories, filenames) in os.walk(os.path.join(FILE_DIR, DIRECTORY_NAME)):
-        for filename in filenames:
-            signature = filename.split("_")[1]
-            signature = signature.replace('+', '%2B').replace('l', '%2F')
+            if CONCENTRATION_COLUMN_HEADER in row:
+                concentration = float(row[CONCENTRATION_COLUMN_HEADER]) * 5
 
-            molarities = {}
-            concentrations = {}
-            for row in get_rows(open(os.path.join(directory, filename))):
-                well = row['Sample Name'].split("_")[0]
+                if well not in concentrations:
+                    concentrations[well] = concentration
+                else:
+                    concentrations[well] = (concentrations[well] + concentration) / 2
 
-                if MOLARITY_COLUMN_HEADER in row:
-                    molarity = float(row[MOLARITY_COLUMN_HEADER]) * 5
+    values = {}
+    for well, molarity in molarities.items():
+        values.setdefault(well, {})[MOLARITY] = str(molarity)
+    for well, concentration in concentrations.items():
+        values.setdefault(well, {})[CONCENTRATION] = str(concentration)
+    return signature, values
 
-                    if well not in molarities:
-                        molarities[well] = molarity
-                    else:
-                        molarities[well] = (molarities[well] + molarity) / 2
 
-                if CONCENTRATION_COLUMN_HEADER in row:
-                    concentration = float(row[CONCENTRATION_COLUMN_HEADER]) * 5
+def update_plates(clarity, updater, plates, index=None):
+    # plates is a list of (signature, values by well), as returned by read_plate.
+    signatures = [signature for signature, values in plates]
+    uris = index.lookup_many(signatures) if index is not None else {}
+    missing = [signature for signature in signatures if signature not in uris]
+    links = clarity.search('containers', 'udf.' + SIGNATURE, missing) if missing else []
 
-                    if well not in concentrations:
-                        concentrations[well] = concentration
-                    else:
-                        concentrations[well] = (concentrations[well] + concentration) / 2
+    fetched = clarity.get_xml(list(uris.values()) + [link.get('uri') for link in links])
+    if index is not None and links:
+        index.add(fetched)
 
-            search_xml = clarity.get_xml(clarity.root + "containers?udf.WTSI%20Container%20Signature=" + signature)
-            container_uri = search_xml.find("container").get('uri')
+    containers = {}
+    for container in fetched:
+        for field in udf_map(container).get(SIGNATURE, ()):
+            containers[field.text] = container
 
-            container_xml = clarity.get_xml(container_uri)
-            placement_uris = {placement.get('uri') for placement in container_xml.findall('placement')}
-            artifact_xmls = clarity.get_xml(placement_uris)
-            sample_uris = {artifact.find('sample').get('uri') for artifact in artifact_xmls}
-            sample_xmls = clarity.get_xml(sample_uris)
+    # Download all the artifacts on the plates in a batch. The samples are downloaded by the updater.
+    clarity.prefetch(containers.values(), 'placement')
 
-            post_xmls = []
+    for signature, values in plates:
+        container = containers.get(signature)
+        if container is None:
+            sys.stderr.write("No container with signature %s\n" % signature)
+            continue
 
-            for placement_uri in placement_uris:
-                artifact_xml = \
-                    [artifact for artifact in artifact_xmls if artifact.get('uri').startswith(placement_uri)][0]
-                sample_uri = artifact_xml.find('sample').get('uri')
-                sample_xml = [sample for sample in sample_xmls if sample.get('uri') == sample_uri][0]
+        artifacts = clarity.get_xml_map(placement.get('uri') for placement in container.findall('placement'))
 
-                well = artifact_xml.find('location').find('value').text.replace(':', '')
+        for artifact in artifacts.values():
+            well = artifact.find('location').find('value').text.replace(':', '')
+            if well in values:
+                updater.update(artifact.find('sample').get('uri'), values[well])
 
-                molarity = str(molarities[well])
-                change_xml(sample_xml, MOLARITY, molarity)
 
-                concentration = str(concentrations[well])
-                change_xml(sample_xml, CONCENTRATION, concentration)
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    dry_run = '--dry-run' in args
+    if dry_run:
+        args.remove('--dry-run')
+    index_paths = [arg.split('=', 1)[1] for arg in args if arg.startswith('--index=')]
+    args = [arg for arg in args if not arg.startswith('--index=')]
+
+    if len(args) >= 1:
+        root_url = args[0]
+        paths = args[1:] or [os.path.join(FILE_DIR, DIRECTORY_NAME)]
+    else:
+        sys.stderr.write("usage: python backfill_caliper.py [--dry-run] [--index=<index_file>] <root_uri> "
+                         "[<file or directory> ...]\n")
+        sys.exit(1)
 
-                post_xmls.append(sample_xml)
+    clarity = Clarity(root_url)
+    updater = UdfUpdater(clarity, 'samples', dry_run=dry_run)
+
+    index = SignatureIndex(index_paths[-1]) if index_paths else None
+    if index is not None:
+        index.refresh(clarity)
+
+    plates = (read_plate(path) for path in iter_files(paths))
+    while True:
+        batch = list(itertools.islice(plates, PLATES_PER_SEARCH))
+        if not batch:
+            break
+        update_plates(clarity, updater, batch, index)
 
-            clarity.batch_post_xml('samples', post_xmls)
+    updater.flush()
+    updater.report()
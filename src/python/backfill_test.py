@@ -4,10 +4,9 @@ import os
 
 import sys
 
-from clarity import Clarity
+from clarity import Clarity, to_columns
 
 FILE_DIR = os.path.dirname(os.path.realpath(__file__))
-FIELD = "{http://genologics.com/ri/userdefined}field"
 SUPPLIER_NAME = "WTSI Supplier Sample Name (SM)"
 
 if __name__ == "__main__":
@@ -42,18 +41,12 @@ if __name__ == "__main__":
     # with open('sample_names.txt', 'w') as f:
     #     f.writelines('\n'.join(uuids))
 
-    batch_size = 100
-
     with open('sample_names.txt', 'r') as fin:
         with open('sample_names_and_suplier.txt', 'w') as fout:
             uuids = [uuid.strip() for uuid in fin]
-            for i in range(0, len(uuids), batch_size):
-                search_xml = clarity.get_xml(
-                    clarity.root + 'samples?' + '&'.join(['name=' + uuid.strip() for uuid in uuids[i:i + batch_size]]))
-                sample_uris = [sample.get('uri') for sample in search_xml.findall('sample')]
-                samples = clarity.get_xml(sample_uris)
-
-                for sample in samples:
-                    supplier = [field.text for field in sample.findall(FIELD) if field.get('name') == SUPPLIER_NAME][0]
+            sample_uris = [sample.get('uri') for sample in clarity.search('samples', 'name', uuids)]
+            samples = clarity.get_xml(sample_uris)
+            columns = to_columns(samples, ['name', 'udf:' + SUPPLIER_NAME])
 
-                    print(sample.find('name').text + ',' + supplier, file=fout)
+            for name, supplier in zip(columns['name'], columns['udf:' + SUPPLIER_NAME]):
+                print(name + ',' + supplier, file=fout)
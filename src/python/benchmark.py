@@ -0,0 +1,571 @@
+#!/usr/bin/env python3
+"""
+Benchmarks of the Clarity client and the configuration tools, run on made up data so that runs before and after a
+change can be compared.
+
+usage: python benchmark.py [--scale=<n>] [--repeat=<n>] [--latency=<seconds>] [--seed=<n>] [--save=<file>]
+                           [--baseline=<file>] [--tolerance=<fraction>] [<benchmark> ...]
+
+The data is made up afresh for every run (the same data for the same scale and seed): at scale 1, 20 plates of 96 wells
+with an artifact and a sample in each, a process per plate, and a configuration of 20 workflows made of 40 shared
+protocols of 6 steps, with 60 process types whose parameters are nested 4 deep. The plates and configuration are
+served by fake_clarity, in a separate process (so the time and memory it uses are not counted), with latency seconds
+added to every request. The benchmarks are:
+    get_xml          the processes, which are downloaded with concurrent single requests
+    batch_get_xml    the samples, with _batch_get_xml
+    cached_get_xml   the artifacts, once they are in the memory cache
+    navigate         the udfs of the sample in every well, with ClarityElement, after prefetch('placement/sample')
+    get_config_tree  the whole configuration, with get_config_tree.get_tree
+    canonical_sort   the expanded configuration tree, in memory
+    remove_same      two copies of the configuration tree (one with a few changes), in memory
+All of them are run unless some are named.
+
+Each benchmark is run repeat times (3 by default) with a new client, and the best and median times are reported along
+with the number of items a second (at the best time), the number of requests (round trips) and the bytes received. The
+peak memory allocated while it runs is measured in one more run, as tracing allocations slows everything down.
+
+--save writes the results to a json file, and --baseline compares them with a file saved before, printing the change in
+every figure. The script exits with 1 if any benchmark is more than tolerance (0.25 by default) slower or uses that
+much more memory than its baseline, or makes more requests.
+"""
+import copy
+import datetime
+import gc
+import json
+import multiprocessing
+import platform
+import random
+import statistics
+import time
+import tracemalloc
+from collections import OrderedDict
+from xml.etree import ElementTree
+
+import os
+import sys
+
+import get_config_tree
+from cache import strip_state
+from canonical_xml import canonical_sort
+from clarity import Clarity, ClarityElement
+from config_diff import remove_same
+from fake_clarity import FakeClarity
+from metrics import Metrics
+
+__author__ = 'rf9'
+
+RI = 'http://genologics.com/ri/'
+UDF = '{http://genologics.com/ri/userdefined}field'
+ROWS = 'ABCDEFGH'
+COLUMNS = 12
+REPEAT = 3
+TOLERANCE = 0.25
+# The size of each part of the data at scale 1.
+PLATES = 20
+WORKFLOWS = 20
+PROTOCOLS = 40
+STEPS = 6
+PROCESS_TYPES = 60
+DEPTH = 4
+CHANGES = 10
+
+
+def _tag(namespace, name):
+    return '{%s%s}%s' % (RI, namespace, name)
+
+
+def _sub(parent, tag, text=None, **attributes):
+    element = ElementTree.SubElement(parent, tag, attributes)
+    if text is not None:
+        element.text = str(text)
+    return element
+
+
+def _udf(parent, name, value, field_type='String'):
+    return _sub(parent, UDF, value, type=field_type, name=name)
+
+
+def make_plates(root, plates, seed=0):
+    # Made up 96 well plates: a container per plate with an artifact and a sample in every well, and a process per
+    # plate with the artifacts as its inputs. Returns the lists of containers, artifacts, samples and processes.
+    rand = random.Random(seed)
+    containers, artifacts, samples, processes = [], [], [], []
+
+    for plate in range(1, plates + 1):
+        container = ElementTree.Element(_tag('container', 'container'), uri='%scontainers/27-%d' % (root, plate),
+                                        limsid='27-%d' % plate)
+        _sub(container, 'name', 'Plate %d' % plate)
+        _sub(container, 'type', uri=root + 'containertypes/1', name='96 well plate')
+        _sub(container, 'occupied-wells', len(ROWS) * COLUMNS)
+        _udf(container, 'WTSI Container Signature', '%08x' % rand.getrandbits(32))
+        containers.append(container)
+
+        process = ElementTree.Element(_tag('process', 'process'), uri='%sprocesses/24-%d' % (root, plate),
+                                      limsid='24-%d' % plate)
+        _sub(process, 'type', 'Post Lib PCR QC GetData')
+        _sub(process, 'date-run', '2014-04-07')
+        processes.append(process)
+
+        for column in range(1, COLUMNS + 1):
+            for row in ROWS:
+                well = '%s:%d' % (row, column)
+                sample_id = 'SMP%dA%s%d' % (plate, row, column)
+                sample_uri = root + 'samples/' + sample_id
+                artifact_id = sample_id + 'PA1'
+                artifact_uri = root + 'artifacts/' + artifact_id
+
+                sample = ElementTree.Element(_tag('sample', 'sample'), uri=sample_uri, limsid=sample_id)
+                _sub(sample, 'name', 'sample_%d_%s' % (plate, well))
+                _sub(sample, 'date-received', '2014-04-07')
+                _sub(sample, 'project', uri=root + 'projects/PRJ1', limsid='PRJ1')
+                _sub(sample, 'artifact', uri=artifact_uri + '?state=1', limsid=artifact_id)
+                _udf(sample, 'WTSI Supplier Sample Name (SM)', 'supplier_%d_%s' % (plate, well))
+                _udf(sample, 'WTSI Library Molarity', '%.2f' % rand.uniform(1, 100), 'Numeric')
+                _udf(sample, 'WTSI Library Concentration', '%.2f' % rand.uniform(1, 100), 'Numeric')
+                samples.append(sample)
+
+                artifact = ElementTree.Element(_tag('artifact', 'artifact'), uri=artifact_uri + '?state=1',
+                                               limsid=artifact_id)
+                _sub(artifact, 'name', 'sample_%d_%s' % (plate, well))
+                _sub(artifact, 'type', 'Analyte')
+                _sub(artifact, 'qc-flag', 'UNKNOWN')
+                location = _sub(artifact, 'location')
+                _sub(location, 'container', uri=container.get('uri'), limsid=container.get('limsid'))
+                _sub(location, 'value', well)
+                _sub(artifact, 'sample', uri=sample_uri, limsid=sample_id)
+                artifacts.append(artifact)
+
+                placement = _sub(container, 'placement', uri=artifact_uri + '?state=1', limsid=artifact_id)
+                _sub(placement, 'value', well)
+
+                io_map = _sub(process, 'input-output-map')
+                _sub(io_map, 'input', uri=artifact_uri + '?state=1', limsid=artifact_id)
+                _sub(io_map, 'output', uri=root + 'artifacts/' + sample_id + 'PA2?state=2',
+                     limsid=sample_id + 'PA2', **{'output-type': 'Analyte', 'output-generation-type': 'PerInput'})
+
+    return containers, artifacts, samples, processes
+
+
+def _nest(parent, depth, rand):
+    # Two children per level, depth levels deep, like the nested options of a process type parameter.
+    if depth == 0:
+        return
+    for index in range(2):
+        child = _sub(parent, 'option', name='option %d' % index)
+        _sub(child, 'value', rand.choice(['true', 'false', rand.randint(0, 1000)]))
+        _nest(child, depth - 1, rand)
+
+
+def make_config(root, workflows, protocols, steps, process_types, depth, seed=0):
+    # A made up configuration of workflows made of protocols (each protocol is used by several workflows), made of
+    # steps, which share process types. Returns the list of workflows, as served at configuration/workflows, and every
+    # object it links to, directly or not.
+    rand = random.Random(seed)
+    objects = []
+
+    types = []
+    for index in range(1, process_types + 1):
+        process_type = ElementTree.Element(_tag('processtype', 'process-type'), uri='%sprocesstypes/%d' % (root, index),
+                                           name='Process type %d' % index)
+        for field in range(rand.randint(2, 6)):
+            _sub(process_type, 'field-definition', name='Field %d' % field)
+        for parameter in range(rand.randint(1, 3)):
+            element = _sub(process_type, 'parameter', name='Parameter %d' % parameter)
+            _sub(element, 'string', 'bash -c "script_%d_%d"' % (index, parameter))
+            _sub(element, 'run-program-per-event', 'false')
+            _nest(element, depth, rand)
+        _sub(process_type, 'process-output-type', 'Analyte')
+        types.append(process_type)
+    objects += types
+
+    protocol_list = []
+    for index in range(1, protocols + 1):
+        protocol_uri = '%sconfiguration/protocols/%d' % (root, index)
+        protocol = ElementTree.Element(_tag('protocolconfiguration', 'protocol'), uri=protocol_uri,
+                                       name='Protocol %d' % index, index=str(index))
+        step_list = _sub(protocol, 'steps')
+        step_uris = ['%s/steps/%d' % (protocol_uri, index * 100 + step) for step in range(steps)]
+        for position, step_uri in enumerate(step_uris):
+            process_type = rand.choice(types)
+            _sub(step_list, 'step', uri=step_uri, name='Step %d.%d' % (index, position))
+
+            step = ElementTree.Element(_tag('protocolconfiguration', 'step'), uri=step_uri,
+                                       name='Step %d.%d' % (index, position), **{'protocol-uri': protocol_uri})
+            _sub(step, 'protocol-step-index', position + 1)
+            _sub(step, 'process-type', process_type.get('name'), uri=process_type.get('uri'))
+            containers = _sub(step, 'permitted-containers')
+            _sub(containers, 'container-type', '96 well plate')
+            for group in ('queue-fields', 'step-fields', 'sample-fields'):
+                fields = _sub(step, group)
+                for field in range(rand.randint(3, 8)):
+                    _sub(fields, group[:-1], name='Field %d' % field, detail='false', style='USER_DEFINED',
+                         **{'attach-to': rand.choice(['Analyte', 'Sample', 'ConfiguredProcess'])})
+            properties = _sub(step, 'step-properties')
+            for step_property in range(rand.randint(2, 6)):
+                _sub(properties, 'step-property', name='property%d' % step_property,
+                     value=rand.choice(['true', 'false', 'Plate']))
+            triggers = _sub(step, 'epp-triggers')
+            for parameter in process_type.findall('parameter'):
+                _sub(triggers, 'epp-trigger', name=parameter.get('name'), type='AUTOMATIC', point='BEFORE',
+                     status='RECORD_DETAILS')
+            transitions = _sub(step, 'transitions')
+            if position + 1 < len(step_uris):
+                _sub(transitions, 'transition', name='Step %d.%d' % (index, position + 1), sequence='1',
+                     **{'next-step-uri': step_uris[position + 1]})
+            objects.append(step)
+
+        objects.append(protocol)
+        protocol_list.append(protocol)
+
+    workflow_list = ElementTree.Element(_tag('workflowconfiguration', 'workflows'))
+    for index in range(1, workflows + 1):
+        workflow_uri = '%sconfiguration/workflows/%d' % (root, index)
+        # Some workflows are archived, and left out of the tree by get_tree.
+        status = 'ACTIVE' if index % 5 else 'ARCHIVED'
+        _sub(workflow_list, 'workflow', uri=workflow_uri, name='Workflow %d' % index, status=status)
+
+        workflow = ElementTree.Element(_tag('workflowconfiguration', 'workflow'), uri=workflow_uri,
+                                       name='Workflow %d' % index, status=status)
+        protocol_links = _sub(workflow, 'protocols')
+        for protocol in rand.sample(protocol_list, min(5, len(protocol_list))):
+            _sub(protocol_links, 'protocol', uri=protocol.get('uri'), name=protocol.get('name'))
+        stages = _sub(workflow, 'stages')
+        for protocol in protocol_links:
+            _sub(stages, 'stage', uri=protocol.get('uri') + '/stages/1', name=protocol.get('name'))
+        objects.append(workflow)
+
+    return workflow_list, objects
+
+
+def modify(tree, changes, seed=0):
+    # Make changes to a tree like the ones between two configurations: texts and attributes changed, and elements
+    # removed. Returns the tree.
+    rand = random.Random(seed)
+    parents = {child: parent for parent in tree.iter() for child in parent}
+
+    for element in rand.sample(list(parents), min(changes, len(parents))):
+        if element not in parents:
+            # Already removed along with its parent.
+            continue
+        choice = rand.randrange(3)
+        if choice == 0:
+            parents[element].remove(element)
+            for descendant in element.iter():
+                parents.pop(descendant, None)
+        elif choice == 1 and element.text:
+            element.text += ' (changed)'
+        else:
+            element.set('changed', 'true')
+
+    return tree
+
+
+class MemoryClarity:
+    # Just enough of Clarity for get_config_tree.expand, serving the made up objects from memory. Every object is
+    # parsed again each time it is asked for, as if it had been downloaded.
+    def __init__(self, xml_list):
+        self._objects = {strip_state(xml.get('uri')): ElementTree.tostring(xml) for xml in xml_list}
+
+    def get_xml_map(self, uri_list, use_cache=True):
+        return OrderedDict((uri, ElementTree.fromstring(self._objects[strip_state(uri)])) for uri in uri_list)
+
+
+def _serve(latency, connection):
+    # Run in a separate process: send the root of the server to connection, then serve the objects (pairs of uri and
+    # xml) sent back.
+    fake = FakeClarity(latency=latency)
+    connection.send(fake.root)
+    for uri, xml in connection.recv():
+        fake.add_at(uri, xml)
+    connection.send(len(fake))
+    fake.serve_forever()
+
+
+class Dataset:
+    # The made up data, and the server it is served from if a benchmark needs one.
+    def __init__(self, scale=1, latency=0, seed=0, server=True):
+        self.latency = latency
+        self.root = 'http://localhost/api/v2/'
+        self._process = None
+        self._connection = None
+
+        # The server is started first, as the uris in the data depend on its port.
+        if server:
+            self._connection, child_connection = multiprocessing.Pipe()
+            self._process = multiprocessing.Process(target=_serve, args=(latency, child_connection), daemon=True)
+            self._process.start()
+            self.root = self._connection.recv()
+
+        containers, artifacts, samples, processes = make_plates(self.root, int(PLATES * scale), seed)
+        self.container_uris = [xml.get('uri') for xml in containers]
+        self.artifact_uris = [xml.get('uri') for xml in artifacts]
+        self.sample_uris = [xml.get('uri') for xml in samples]
+        self.process_uris = [xml.get('uri') for xml in processes]
+
+        self.workflows, config = make_config(self.root, int(WORKFLOWS * scale), int(PROTOCOLS * scale), STEPS,
+                                             int(PROCESS_TYPES * scale), DEPTH, seed)
+
+        # The configuration tree as get_tree makes it (objects shared between workflows are shared in the tree too),
+        # and as it is when read back from a file.
+        self.config_tree = copy.deepcopy(self.workflows)
+        get_config_tree.expand(MemoryClarity(config), self.config_tree)
+        self.config_xml = ElementTree.tostring(self.config_tree)
+        self.changes = int(CHANGES * scale)
+
+        if server:
+            objects = [(xml.get('uri'), ElementTree.tostring(xml))
+                       for xml in containers + artifacts + samples + processes + config]
+            objects.append((self.root + 'configuration/workflows', ElementTree.tostring(self.workflows)))
+            self._connection.send(objects)
+            # Wait until they are all being served.
+            self._connection.recv()
+
+    def stop(self):
+        if self._process is not None:
+            self._process.terminate()
+            self._process.join()
+            self._process = None
+
+    def client(self):
+        clarity = Clarity(self.root, user='benchmark', password='benchmark', metrics=Metrics())
+        # Only count the requests made by the benchmark, not the one that checked the credentials.
+        clarity.metrics.clear()
+        return clarity
+
+
+# Each benchmark takes the dataset and returns the client it uses (None if it does not make requests) and the function
+# to time, which returns the number of items it went through. Everything done before that function is called is not
+# timed.
+def bench_get_xml(data):
+    clarity = data.client()
+    return clarity, lambda: len(clarity.get_xml(data.process_uris))
+
+
+def bench_batch_get_xml(data):
+    clarity = data.client()
+    return clarity, lambda: len(clarity._batch_get_xml(data.sample_uris, 'samples'))
+
+
+def bench_cached_get_xml(data):
+    clarity = data.client()
+    clarity.get_xml(data.artifact_uris)
+    clarity.metrics.clear()
+    return clarity, lambda: len(clarity.get_xml(data.artifact_uris))
+
+
+def bench_navigate(data):
+    clarity = data.client()
+
+    def run():
+        containers = ClarityElement(clarity, clarity.get_xml(data.container_uris)).prefetch('placement/sample')
+        values = []
+        for container in containers:
+            for placement in container.get('placement'):
+                sample = placement.get('sample')
+                values.append((container.get_first('limsid'), placement.get('value').get_first('text'),
+                               sample.get_first('limsid'), sample.get_udf('WTSI Library Molarity').get_first('text')))
+        return len(values)
+
+    return clarity, run
+
+
+def bench_get_config_tree(data):
+    clarity = data.client()
+
+    def run():
+        manifest = {}
+        get_config_tree.get_tree(clarity, manifest)
+        return len(manifest)
+
+    return clarity, run
+
+
+def bench_canonical_sort(data):
+    tree = copy.deepcopy(data.config_tree)
+
+    def run():
+        canonical_sort(tree)
+        return sum(1 for element in tree.iter())
+
+    return None, run
+
+
+def bench_remove_same(data):
+    tree1 = ElementTree.fromstring(data.config_xml)
+    tree2 = modify(ElementTree.fromstring(data.config_xml), data.changes)
+    size = sum(1 for element in tree1.iter()) + sum(1 for element in tree2.iter())
+
+    def run():
+        remove_same(tree1, tree2)
+        return size
+
+    return None, run
+
+
+BENCHMARKS = OrderedDict([
+    ('get_xml', bench_get_xml),
+    ('batch_get_xml', bench_batch_get_xml),
+    ('cached_get_xml', bench_cached_get_xml),
+    ('navigate', bench_navigate),
+    ('get_config_tree', bench_get_config_tree),
+    ('canonical_sort', bench_canonical_sort),
+    ('remove_same', bench_remove_same),
+])
+IN_MEMORY = ('canonical_sort', 'remove_same')
+
+
+def _requests(clarity):
+    if clarity is None:
+        return None, None
+    requests = clarity.metrics.snapshot()['requests']
+    return sum(stats['count'] for stats in requests), sum(stats['bytes_received'] for stats in requests)
+
+
+def measure(benchmark, data, repeat=REPEAT):
+    times = []
+    for run_number in range(repeat):
+        clarity, run = benchmark(data)
+        gc.collect()
+        start = time.perf_counter()
+        items = run()
+        times.append(time.perf_counter() - start)
+        round_trips, bytes_received = _requests(clarity)
+
+    # Only the memory allocated after tracing starts counts, so the set up is left out of the peak.
+    clarity, run = benchmark(data)
+    gc.collect()
+    tracemalloc.start()
+    try:
+        run()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    best = min(times)
+    return OrderedDict([
+        ('items', items),
+        ('best_seconds', best),
+        ('median_seconds', statistics.median(times)),
+        ('items_per_second', items / best if best else None),
+        ('round_trips', round_trips),
+        ('bytes_received', bytes_received),
+        ('peak_memory', peak),
+    ])
+
+
+def run_benchmarks(names, scale=1, repeat=REPEAT, latency=0, seed=0):
+    data = Dataset(scale, latency, seed, server=any(name not in IN_MEMORY for name in names))
+    try:
+        results = OrderedDict()
+        for name in names:
+            results[name] = measure(BENCHMARKS[name], data, repeat)
+            print_result(name, results[name])
+    finally:
+        data.stop()
+
+    return OrderedDict([
+        ('created', str(datetime.datetime.now())),
+        ('python', platform.python_version()),
+        ('machine', platform.node()),
+        ('scale', scale),
+        ('repeat', repeat),
+        ('latency', latency),
+        ('seed', seed),
+        ('benchmarks', results),
+    ])
+
+
+def _format(value, unit=''):
+    if value is None:
+        return '-'
+    if isinstance(value, float):
+        return '%.4g%s' % (value, unit)
+    return '%d%s' % (value, unit)
+
+
+def print_header():
+    print('%-16s %8s %10s %10s %12s %8s %12s %10s' % ('benchmark', 'items', 'best s', 'median s', 'items/s',
+                                                      'requests', 'received', 'peak MiB'))
+
+
+def print_result(name, result):
+    print('%-16s %8s %10s %10s %12s %8s %12s %10s' % (
+        name, _format(result['items']), _format(result['best_seconds']), _format(result['median_seconds']),
+        _format(result['items_per_second']), _format(result['round_trips']), _format(result['bytes_received']),
+        _format(result['peak_memory'] / 1024 / 1024)))
+
+
+def compare(results, baseline, tolerance=TOLERANCE):
+    # Print the change in every figure since baseline, and return the list of the benchmarks that got worse.
+    for setting in ('scale', 'latency', 'seed'):
+        if results.get(setting) != baseline.get(setting):
+            print('Warning: the baseline was run with %s=%s, not %s' % (setting, baseline.get(setting),
+                                                                      results.get(setting)))
+
+    def change(key, before, after, unit=1, unit_name=''):
+        if before.get(key) is None or after.get(key) is None:
+            return '-'
+        text = '%s -> %s' % (_format(before[key] / unit, unit_name), _format(after[key] / unit, unit_name))
+        if before[key]:
+            text += ' (%+.1f%%)' % (100.0 * (after[key] - before[key]) / before[key])
+        return text
+
+    print('\nCompared with the baseline of %s:' % baseline.get('created'))
+    regressions = []
+    for name, after in results['benchmarks'].items():
+        before = baseline['benchmarks'].get(name)
+        if before is None:
+            print('%-16s not in the baseline' % name)
+            continue
+
+        print('%-16s time %s, requests %s, peak memory %s' % (name, change('best_seconds', before, after),
+                                                              change('round_trips', before, after),
+                                                              change('peak_memory', before, after, 1024 * 1024,
+                                                                     ' MiB')))
+
+        worse = []
+        if after['best_seconds'] > before['best_seconds'] * (1 + tolerance):
+            worse.append('time')
+        if (after['round_trips'] or 0) > (before['round_trips'] or 0):
+            worse.append('requests')
+        if after['peak_memory'] > before['peak_memory'] * (1 + tolerance):
+            worse.append('peak memory')
+        if worse:
+            regressions.append((name, worse))
+
+    for name, worse in regressions:
+        print('Regression in %s: %s' % (name, ', '.join(worse)))
+    return regressions
+
+
+if __name__ == '__main__':
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    options = dict(arg[2:].split('=', 1) for arg in sys.argv[1:] if arg.startswith('--') and '=' in arg)
+
+    unknown = [name for name in args if name not in BENCHMARKS]
+    if unknown or not set(options) <= {'scale', 'repeat', 'latency', 'seed', 'save', 'baseline', 'tolerance'}:
+        sys.stderr.write("usage: python benchmark.py [--scale=<n>] [--repeat=<n>] [--latency=<seconds>] [--seed=<n>] "
+                         "[--save=<file>] [--baseline=<file>] [--tolerance=<fraction>] [<benchmark> ...]\n"
+                         "benchmarks: %s\n" % ' '.join(BENCHMARKS))
+        sys.exit(1)
+
+    # Every run starts with empty caches and nothing is recorded, whatever the environment says.
+    for variable in ('CLARITY_CACHE', 'CLARITY_RECORD', 'CLARITY_METRICS'):
+        os.environ.pop(variable, None)
+
+    print_header()
+    results = run_benchmarks(args or list(BENCHMARKS),
+                             scale=float(options.get('scale', 1)),
+                             repeat=int(options.get('repeat', REPEAT)),
+                             latency=float(options.get('latency', 0)),
+                             seed=int(options.get('seed', 0)))
+
+    if 'save' in options:
+        with open(options['save'], 'w') as out_file:
+            json.dump(results, out_file, indent=2)
+
+    if 'baseline' in options:
+        with open(options['baseline']) as in_file:
+            baseline = json.load(in_file)
+        if compare(results, baseline, float(options.get('tolerance', TOLERANCE))):
+            sys.exit(1)
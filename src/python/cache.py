@@ -0,0 +1,346 @@
+#!/usr/bin/env python3
+"""
+Caches used by clarity.Clarity to avoid downloading the same objects more than once.
+
+ElementCache is the in-memory cache of parsed elements. It is bounded by an approximate memory budget and evicts the
+least recently used elements first, starting with the object types that are cheapest to fetch again (artifacts) and
+never evicting pinned types (configuration). An element cached under more than one uri of the same object (an artifact
+with and without its state) is stored once, and removing or replacing it removes it under all of them.
+
+udf_map gives the UDF fields of an element by name. It is worked out once per element (when it is cached, or the first
+time it is asked for) and remembered for as long as the element exists.
+
+DiskCache keeps the raw xml of every downloaded object in a sqlite database keyed by uri, so that separate runs of the
+scripts can share what has already been fetched. Each object type has its own time to live, after which the entry is
+stale and will be downloaded again (or revalidated with a conditional request when the server gave an ETag or
+Last-Modified header).
+"""
+import re
+import sqlite3
+import threading
+import time
+import weakref
+from collections import OrderedDict, defaultdict
+
+__author__ = 'rf9'
+
+MINUTE = 60
+HOUR = 60 * MINUTE
+DAY = 24 * HOUR
+
+# How long (in seconds) a cached object of each type is trusted without asking the server again.
+DEFAULT_TTLS = {
+    'configuration': DAY,
+    'processtypes': DAY,
+    'reagenttypes': DAY,
+    'containertypes': DAY,
+    'researchers': DAY,
+    'labs': DAY,
+    'projects': HOUR,
+    'processes': HOUR,
+    'containers': 10 * MINUTE,
+    'samples': 10 * MINUTE,
+    'artifacts': 10 * MINUTE,
+    'files': 10 * MINUTE,
+}
+DEFAULT_TTL = 10 * MINUTE
+
+FIELD = "{http://genologics.com/ri/userdefined}field"
+STATE_PATTERN = re.compile(r'\?state=\d+$')
+
+# Older versions of SQLite allow at most 999 parameters in a query.
+SQLITE_MAX_PARAMETERS = 500
+
+DEFAULT_MEMORY_BUDGET = 512 * 1024 * 1024
+# Approximate size in bytes of an Element and its attribute dictionary, on top of the strings they hold.
+ELEMENT_OVERHEAD = 200
+ATTRIBUTE_OVERHEAD = 50
+
+# Object types that are never evicted, as they are small, few and referenced from everywhere.
+PINNED_TYPES = ('configuration', 'processtypes', 'reagenttypes', 'containertypes')
+# Lower priorities are evicted first. Types not listed get DEFAULT_PRIORITY.
+EVICTION_PRIORITIES = {
+    'artifacts': 0,
+    'files': 0,
+    'samples': 1,
+    'containers': 1,
+    'processes': 2,
+    'projects': 3,
+    'researchers': 3,
+    'labs': 3,
+}
+DEFAULT_PRIORITY = 1
+
+
+def strip_state(uri):
+    # Artifact uris may end with the state of the artifact, which is not part of its identity.
+    return STATE_PATTERN.sub('', uri) if uri else uri
+
+
+_udf_maps = weakref.WeakKeyDictionary()
+_udf_maps_lock = threading.Lock()
+
+
+def udf_map(element):
+    # A dictionary of UDF name to the list of field elements with that name, for the direct children of element.
+    with _udf_maps_lock:
+        udfs = _udf_maps.get(element)
+    if udfs is None:
+        udfs = {}
+        for field in element.findall(FIELD):
+            udfs.setdefault(field.get('name'), []).append(field)
+        with _udf_maps_lock:
+            _udf_maps[element] = udfs
+    return udfs
+
+
+def forget_udfs(element):
+    # Call after changing the UDF fields of an element, so udf_map looks at them again.
+    with _udf_maps_lock:
+        _udf_maps.pop(element, None)
+
+
+def element_size(element):
+    size = 0
+    for node in element.iter():
+        size += ELEMENT_OVERHEAD + len(node.tag) + len(node.text or '') + len(node.tail or '')
+        for key, value in node.attrib.items():
+            size += ATTRIBUTE_OVERHEAD + len(key) + len(value)
+    return size
+
+
+class ElementCache:
+    def __init__(self, memory_budget=DEFAULT_MEMORY_BUDGET, object_type=None, pinned_types=PINNED_TYPES,
+                 priorities=None):
+        self.memory_budget = memory_budget
+        self.object_type = object_type or (lambda uri: None)
+        self.pinned_types = set(pinned_types)
+        self.priorities = dict(EVICTION_PRIORITIES)
+        self.priorities.update(priorities or {})
+
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._lock = threading.RLock()
+        # Entries are keyed by uri without the artifact state. An element cached under several uris of the same
+        # object (e.g. with and without the state) is one entry, counted once.
+        # Eviction priority (None for pinned) -> key -> (element, size), in least recently used order.
+        self._tiers = defaultdict(OrderedDict)
+        self._priority = {}
+        # Key -> the uris its element is cached under, and uri -> key.
+        self._aliases = {}
+        self._keys = {}
+
+    def _priority_of(self, uri):
+        object_type = self.object_type(uri)
+        if object_type in self.pinned_types:
+            return None
+        return self.priorities.get(object_type, DEFAULT_PRIORITY)
+
+    def get(self, uri, default=None):
+        with self._lock:
+            key = self._keys.get(uri)
+            if key is None:
+                self.misses += 1
+                return default
+
+            tier = self._tiers[self._priority[key]]
+            tier.move_to_end(key)
+            self.hits += 1
+            return tier[key][0]
+
+    def __getitem__(self, uri):
+        element = self.get(uri)
+        if element is None:
+            raise KeyError(uri)
+        return element
+
+    def __setitem__(self, uri, element):
+        with self._lock:
+            key = strip_state(uri)
+            if key in self._priority:
+                tier = self._tiers[self._priority[key]]
+                if tier[key][0] is element:
+                    # Another uri of an element already cached.
+                    self._aliases[key].add(uri)
+                    self._keys[uri] = key
+                    tier.move_to_end(key)
+                    return
+                self._remove(key)
+
+            priority = self._priority_of(uri)
+            size = element_size(element)
+            self._tiers[priority][key] = (element, size)
+            self._priority[key] = priority
+            self._aliases[key] = {uri}
+            self._keys[uri] = key
+            self.size += size
+
+            forget_udfs(element)
+            udf_map(element)
+
+            self._evict()
+
+    def __delitem__(self, uri):
+        # Removes the element for uri, under every uri it is cached under.
+        with self._lock:
+            self._remove(self._keys[uri])
+
+    def discard(self, uri):
+        # Remove the cached element for uri, or any other state of the same object, if there is one.
+        with self._lock:
+            key = strip_state(uri)
+            if key in self._priority:
+                self._remove(key)
+
+    def _remove(self, key):
+        priority = self._priority.pop(key)
+        element, size = self._tiers[priority].pop(key)
+        self.size -= size
+        for uri in self._aliases.pop(key):
+            del self._keys[uri]
+
+    def __contains__(self, uri):
+        with self._lock:
+            return uri in self._keys
+
+    def __len__(self):
+        # The number of elements cached, however many uris they are cached under.
+        return len(self._priority)
+
+    def __iter__(self):
+        with self._lock:
+            return iter(list(self._keys))
+
+    def _evict(self):
+        if self.memory_budget is None:
+            return
+
+        for priority in sorted(p for p in self._tiers if p is not None):
+            tier = self._tiers[priority]
+            while tier and self.size > self.memory_budget:
+                key, (element, size) = tier.popitem(last=False)
+                del self._priority[key]
+                for uri in self._aliases.pop(key):
+                    del self._keys[uri]
+                self.size -= size
+                self.evictions += 1
+
+            if self.size <= self.memory_budget:
+                return
+
+    def clear(self):
+        with self._lock:
+            self._tiers.clear()
+            self._priority.clear()
+            self._aliases.clear()
+            self._keys.clear()
+            self.size = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._priority),
+                'size': self.size,
+                'memory_budget': self.memory_budget,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+
+class CacheEntry:
+    def __init__(self, uri, data, etag, last_modified, fetched, ttl):
+        self.uri = uri
+        self.data = data
+        self.etag = etag
+        self.last_modified = last_modified
+        self.fetched = fetched
+        self.ttl = ttl
+
+    @property
+    def fresh(self):
+        return time.time() - self.fetched < self.ttl
+
+    @property
+    def revalidatable(self):
+        return bool(self.etag or self.last_modified)
+
+
+def select_in(connection, query, values, parameters=()):
+    # Run query, which has one 'IN (%s)' to fill with values, and return all the rows. The values are sent in chunks to
+    # keep under SQLite's limit on the number of parameters in a query. parameters are sent before the values.
+    values = list(values)
+    rows = []
+    for i in range(0, len(values), SQLITE_MAX_PARAMETERS):
+        chunk = values[i:i + SQLITE_MAX_PARAMETERS]
+        rows += connection.execute(query % ', '.join('?' * len(chunk)), list(parameters) + chunk).fetchall()
+    return rows
+
+
+class DiskCache:
+    def __init__(self, path, ttls=None, default_ttl=DEFAULT_TTL):
+        self.path = path
+        self.ttls = dict(DEFAULT_TTLS)
+        self.ttls.update(ttls or {})
+        self.default_ttl = default_ttl
+
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._connection:
+            self._connection.execute('CREATE TABLE IF NOT EXISTS entity ('
+                                     'uri TEXT PRIMARY KEY, '
+                                     'object_type TEXT, '
+                                     'data BLOB NOT NULL, '
+                                     'etag TEXT, '
+                                     'last_modified TEXT, '
+                                     'fetched REAL NOT NULL)')
+
+    def ttl(self, object_type):
+        return self.ttls.get(object_type, self.default_ttl)
+
+    def get(self, uri):
+        with self._lock:
+            row = self._connection.execute('SELECT object_type, data, etag, last_modified, fetched FROM entity '
+                                           'WHERE uri = ?', (uri,)).fetchone()
+        if row is None:
+            return None
+
+        object_type, data, etag, last_modified, fetched = row
+        return CacheEntry(uri, data, etag, last_modified, fetched, self.ttl(object_type))
+
+    def put(self, uri, object_type, data, etag=None, last_modified=None):
+        self.put_many([(uri, data, etag, last_modified)], object_type)
+
+    def put_many(self, entries, object_type):
+        now = time.time()
+        with self._lock, self._connection:
+            self._connection.executemany('INSERT OR REPLACE INTO entity VALUES (?, ?, ?, ?, ?, ?)',
+                                         [(uri, object_type, data, etag, last_modified, now)
+                                          for uri, data, etag, last_modified in entries])
+
+    def touch(self, uri):
+        # The server confirmed the cached copy is still current.
+        with self._lock, self._connection:
+            self._connection.execute('UPDATE entity SET fetched = ? WHERE uri = ?', (time.time(), uri))
+
+    def delete(self, uri):
+        # Delete the entry for uri, and for every other state of the same object.
+        key = strip_state(uri)
+        with self._lock, self._connection:
+            # The states of key are the uris from key?state= up to (not including) key?state> ('>' follows '=').
+            self._connection.execute('DELETE FROM entity WHERE uri = ? OR (uri >= ? AND uri < ?)',
+                                     (key, key + '?state=', key + '?state>'))
+
+    def clear(self, object_type=None):
+        with self._lock, self._connection:
+            if object_type is None:
+                self._connection.execute('DELETE FROM entity')
+            else:
+                self._connection.execute('DELETE FROM entity WHERE object_type = ?', (object_type,))
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
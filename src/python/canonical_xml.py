@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+"""
+Content hashes and canonical ordering for xml trees where the order of children does not matter.
+
+The hash of an element covers its tag, attributes, text and the hashes of its children (in sorted order, so the order
+of the children does not change it). Two elements with equal hashes have the same content. Hashes are worked out
+bottom-up, once per element, so hashing a whole tree is linear in its size. The tail text of an element (the text
+between it and its next sibling) is ignored, like the whitespace of a pretty-printed document.
+
+canonical_sort reorders the children of every element by tag and then hash, so that trees with the same content are
+always written out identically whatever order they were downloaded in.
+"""
+import hashlib
+
+__author__ = 'rf9'
+
+
+class TreeHasher:
+    def __init__(self):
+        # Keyed by id, as elements are not hashable by value. Only valid while the tree is unchanged.
+        self._hashes = {}
+
+    def hash(self, element):
+        digest = self._hashes.get(id(element))
+        if digest is None:
+            sha = hashlib.sha1()
+            sha.update(element.tag.encode('utf-8'))
+            for key, value in sorted(element.items()):
+                sha.update(b'\0@' + key.encode('utf-8') + b'=' + value.encode('utf-8'))
+            sha.update(b'\0#' + (element.text or '').encode('utf-8'))
+            for child_digest in sorted(self.hash(child) for child in element):
+                sha.update(b'\0/' + child_digest)
+            digest = sha.digest()
+            self._hashes[id(element)] = digest
+        return digest
+
+    def hexdigest(self, element):
+        return self.hash(element).hex()
+
+    def sort_key(self, element):
+        # Group by tag for readability, then by content. The tail only breaks ties between otherwise equal elements.
+        return element.tag, self.hash(element), element.tail or ''
+
+
+def canonical_sort(tree, hasher=None):
+    # Sort the children of every element in the tree into canonical order, in place. Returns the hash of the tree.
+    hasher = hasher or TreeHasher()
+    sorted_ids = set()
+
+    def sort(element):
+        # Elements can be shared between several parents, so only sort each one once.
+        if id(element) in sorted_ids:
+            return
+        sorted_ids.add(id(element))
+
+        for child in element:
+            sort(child)
+
+        element[:] = sorted(element, key=hasher.sort_key)
+
+    sort(tree)
+    return hasher.hash(tree)
@@ -1,26 +1,64 @@
 #!/usr/bin/env python3
+"""
+Check whether the workflow configuration of a Clarity server has changed since this was last run.
+
+usage: python check_same.py <root_uri_prod> <directory> [<max_age>]
+
+Each run takes a snapshot of the configuration tree (see get_config_tree) and adds it to a SnapshotStore in the
+directory, which only stores the parts of the tree that are new. By default every configuration object is downloaded
+on every run, so every change is seen by the next run, and nothing is cached between runs: Clarity gives no ETag or
+Last-Modified to check a cached object with, so a cache would save no downloads. Giving a max_age in seconds keeps the
+downloaded objects in a disk cache in the directory and reuses those downloaded less than that long ago without asking
+the server, which is faster but means a change made in that time is only seen by a later run.
+
+If the configuration changed since the previous snapshot, <date>_prod.xml is written with the whole configuration,
+<date>_prod_cmp_1.xml and <date>_prod_cmp_2.xml with only the parts that differ (as config_diff does), and
+<date>_changes.json with the paths and configuration object uris that changed, and the change is reported on stderr.
+"""
 
 import datetime
-import getpass
+import json
 import os
+from xml.etree import ElementTree
 
 import sys
 
 import get_config_tree
 import config_diff
 
+from cache import DiskCache
+from canonical_xml import TreeHasher
 from clarity import Clarity
+from snapshot_store import SnapshotStore
 
 __author__ = 'rf9'
 
+CONFIGURATION_TYPES = ['configuration', 'processtypes', 'reagenttypes', 'containertypes']
+MAX_AGE = 0
+
+
+def previous_tree(store, directory):
+    # The tree of the latest snapshot, or of the latest _prod.xml file written before there was a snapshot store.
+    latest = store.latest()
+    if latest is not None:
+        return latest, store.load(latest)
+
+    prod_filenames = sorted(filename for filename in os.listdir(directory) if filename.endswith('_prod.xml'))
+    if prod_filenames:
+        return None, ElementTree.parse(os.path.join(directory, prod_filenames[-1])).getroot()
+
+    return None, None
+
+
 if __name__ == "__main__":
-    if len(sys.argv) == 3:
+    if len(sys.argv) in (3, 4):
         root_url = sys.argv[1]
         directory = sys.argv[2]
         if directory.endswith('/'):
             directory = directory[:-1]
+        max_age = float(sys.argv[3]) if len(sys.argv) == 4 else MAX_AGE
     else:
-        sys.stderr.write("usage: python check_same.py <root_uri_prod> <directory>\n")
+        sys.stderr.write("usage: python check_same.py <root_uri_prod> <directory> [<max_age>]\n")
         sys.exit(1)
 
     date = str(datetime.datetime.now()).replace(' ', '_')
@@ -28,19 +66,48 @@ if __name__ == "__main__":
     if not os.path.exists(directory):
         os.makedirs(directory)
 
-    # Save current snapshot to directory
     prod_file = '%s/%s_prod.xml' % (directory, date)
     cmp_file1 = '%s/%s_prod_cmp_1.xml' % (directory, date)
     cmp_file2 = '%s/%s_prod_cmp_2.xml' % (directory, date)
+    changes_file = '%s/%s_changes.json' % (directory, date)
+
+    store = SnapshotStore(directory + '/snapshots')
+    previous_name, previous = previous_tree(store, directory)
+
+    if max_age > 0:
+        ttls = {object_type: max_age for object_type in CONFIGURATION_TYPES}
+        disk_cache = DiskCache(directory + '/cache.sqlite', ttls=ttls)
+    else:
+        disk_cache = None
+        # Nor use the shared cache named by CLARITY_CACHE, which would keep configuration objects for a day.
+        os.environ.pop('CLARITY_CACHE', None)
+    clarity = Clarity(root_url, disk_cache=disk_cache)
+
+    manifest = {}
+    workflows = get_config_tree.get_tree(clarity, manifest)
+    root_hash, new_objects = store.save(date, workflows, manifest)
+    if disk_cache is not None:
+        disk_cache.close()
+
+    if previous is not None and TreeHasher().hexdigest(previous) == root_hash:
+        sys.exit(0)
 
-    clarity = Clarity(root_url)
+    with open(prod_file, 'w') as out_file:
+        out_file.write(ElementTree.tostring(workflows).decode('ascii'))
 
-    get_config_tree.main(clarity, prod_file)
+    if previous is None:
+        sys.exit(0)
 
-    filenames = list(os.walk(directory))[0][2]
+    # The configuration objects are shared between the places they are used in workflows, which diff cannot handle.
+    workflows = config_diff.unshare(workflows)
+    changes = config_diff.compare(previous, workflows)
+    objects = store.changed_objects(previous_name, date) if previous_name is not None else None
 
-    prod_filenames = [directory + '/' + filename for filename in filenames if filename.endswith('_prod.xml')]
+    with open(cmp_file1, mode='w') as out_file:
+        out_file.write(ElementTree.tostring(previous).decode('ascii'))
+    with open(cmp_file2, mode='w') as out_file:
+        out_file.write(ElementTree.tostring(workflows).decode('ascii'))
+    with open(changes_file, mode='w') as out_file:
+        json.dump({'changes': changes, 'objects': objects}, out_file, indent=2)
 
-    if len(prod_filenames) >= 2:
-        if not config_diff.main(prod_filenames[-2], prod_filenames[-1], cmp_file1, cmp_file2):
-            sys.stderr.write('%s workflow configuration changed\n' % date)
+    sys.stderr.write('%s workflow configuration changed\n' % date)
@@ -1,141 +1,661 @@
 #!/usr/bin/env python3
 
+import atexit
 import getpass
+import logging
 import os
 import re
 import urllib.request as request
-from collections import defaultdict
+from collections import Counter, OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
 from urllib.error import HTTPError
 from xml.etree import ElementTree
 
 import sys
 
+from cache import DiskCache, ElementCache, strip_state, udf_map
+from fixtures import RecordingOpener
+from governor import Governor
+from metrics import Metrics
+from transport import PooledOpener
+
 BATCHABLE = ('artifacts', 'containers', 'files', 'samples')
 FIELD = "{http://genologics.com/ri/userdefined}field"
+MAX_WORKERS = 8
+BATCH_SIZE = 500
+MAX_RETRIES = 2
+# Keep search urls below the length that servers and proxies commonly start refusing.
+MAX_URL_LENGTH = 2000
+# The children of a page of a list or search that link to other pages rather than to objects.
+PAGE_LINKS = ('next-page', 'previous-page')
 
 __author__ = 'rf9'
 
+logger = logging.getLogger(__name__)
+
+# Shared by every client when CLARITY_METRICS names a file to write them to at exit.
+_exit_metrics = None
+
 
 class ClarityException(Exception):
     pass
 
 
-class Clarity:
-    def __init__(self, root, user=None, password=None):
+def links_xml(uri_list, object_type):
+    # The body of a batch/retrieve request.
+    builder = ElementTree.TreeBuilder()
+    builder.start('ri:links', {
+        'xmlns:ri': "http://genologics.com/ri",
+    })
+    xml_element = builder.close()
+
+    for uri in uri_list:
+        child = ElementTree.TreeBuilder().start('link', {
+            'uri': uri,
+            'rel': object_type,
+        })
+        xml_element.append(child)
+
+    return ElementTree.tostring(xml_element)
+
+
+def details_xml(xml_list):
+    # The body of a batch/update request.
+    builder = ElementTree.TreeBuilder()
+    builder.start('ns0:details', {
+    })
+    element = builder.close()
+
+    for xml in xml_list:
+        element.append(xml)
+
+    return ElementTree.tostring(element)
+
+
+def page_links(page):
+    # The links to objects on a page of a list or search.
+    return [child for child in page if child.tag not in PAGE_LINKS]
+
+
+def to_columns(xml_list, fields):
+    # Extract fields from every element in xml_list in a single pass, returning an OrderedDict of field to the list of
+    # its values (None where an element does not have it), e.g.
+    #   to_columns(samples, ['name', 'limsid', 'udf:WTSI Supplier Sample Name (SM)'])
+    # A field of 'udf:<name>' is the value of that UDF, otherwise it is the attribute of that name if the element has
+    # one, or the text of the child with that tag.
+    columns = OrderedDict((field, []) for field in fields)
+    getters = []
+    for field in fields:
+        if field.startswith('udf:'):
+            udf_name = field[len('udf:'):]
+            getters.append(lambda xml, udf_name=udf_name: next((udf.text for udf in udf_map(xml).get(udf_name, ())),
+                                                               None))
+        else:
+            getters.append(lambda xml, field=field: xml.get(field) if field in xml.attrib else xml.findtext(field))
+
+    appends = [column.append for column in columns.values()]
+    for xml in xml_list:
+        for append, getter in zip(appends, getters):
+            append(getter(xml))
+
+    return columns
+
+
+def exit_metrics():
+    # The Metrics written to the file named by CLARITY_METRICS when the script exits, or None if it is not set.
+    global _exit_metrics
+    if _exit_metrics is None and os.environ.get('CLARITY_METRICS'):
+        _exit_metrics = Metrics()
+        atexit.register(_exit_metrics.dump, os.environ['CLARITY_METRICS'])
+    return _exit_metrics
+
+
+def iter_children(source):
+    # Incrementally parse an xml document and yield each child of the root element as soon as its end tag has been
+    # read. Each child is detached from the root once yielded, so the whole document is never held in memory.
+    depth = 0
+    root = None
+    for event, element in ElementTree.iterparse(source, events=('start', 'end')):
+        if event == 'start':
+            if root is None:
+                root = element
+            depth += 1
+        else:
+            depth -= 1
+            if depth == 1:
+                root.remove(element)
+                yield element
+
+
+class ClarityCache:
+    # The caching shared by Clarity and AsyncClarity, which only differ in how they make requests. Needs root, cache,
+    # disk_cache and metrics attributes.
+    def _from_cache(self, uri_list, use_cache):
+        # Remove duplicates, keeping the order the uris were given in.
+        uri_list = list(OrderedDict.fromkeys(uri_list))
+
+        elements = []
+
+        # Get all the elements you can from the cache
+        if use_cache:
+            missing = []
+            lookups = Counter()
+            for uri in uri_list:
+                element = self.cache.get(uri)
+                if element is not None:
+                    elements.append(element)
+                else:
+                    missing.append(uri)
+                lookups[self._object_type(uri), 'miss' if element is None else 'hit'] += 1
+            uri_list = missing
+
+            for (object_type, result), count in lookups.items():
+                self.metrics.record_cache('memory', object_type, result, count)
+
+        stale_entries = {}
+        if use_cache and self.disk_cache is not None:
+            disk_elements, uri_list, stale_entries = self._get_from_disk_cache(uri_list)
+            elements += disk_elements
+
+        # Split the uris that are left into their object types
+        partitioned_uris = defaultdict(list)
+        for uri in uri_list:
+            partitioned_uris[self._object_type(uri)].append(uri)
+
+        return elements, partitioned_uris, stale_entries
+
+    def _object_type(self, uri):
+        # Match a string of not '/' after the root url.
+        m = re.match(re.escape(self.root) + '([^/]*)', uri)
+        return m.group(1) if m else None
+
+    def _get_from_disk_cache(self, uri_list):
+        elements = []
+        missing = []
+        stale_entries = {}
+        lookups = Counter()
+
+        for uri in uri_list:
+            entry = self.disk_cache.get(uri)
+            if entry is not None and entry.fresh:
+                element = ElementTree.fromstring(entry.data)
+                self.cache[uri] = element
+                elements.append(element)
+            else:
+                if entry is not None and entry.revalidatable:
+                    stale_entries[uri] = entry
+                missing.append(uri)
+            lookups[self._object_type(uri), 'miss' if entry is None else 'hit' if entry.fresh else 'stale'] += 1
+
+        for (object_type, result), count in lookups.items():
+            self.metrics.record_cache('disk', object_type, result, count)
+
+        return elements, missing, stale_entries
+
+    @staticmethod
+    def _conditional_headers(stale_entry):
+        # Headers asking the server to only send an object if it has changed since stale_entry was cached.
+        headers = {}
+        if stale_entry is not None:
+            if stale_entry.etag:
+                headers['If-None-Match'] = stale_entry.etag
+            if stale_entry.last_modified:
+                headers['If-Modified-Since'] = stale_entry.last_modified
+        return headers
+
+    def _cache_downloaded(self, uri, data, etag=None, last_modified=None):
+        # Parse and cache an object downloaded on its own, returning its element.
+        # Searches are never kept between runs, as new objects may match them at any time.
+        if self.disk_cache is not None and '?' not in uri:
+            self.disk_cache.put(uri, self._object_type(uri), data, etag, last_modified)
+
+        element = ElementTree.fromstring(data)
+        self.cache[uri] = element
+        return element
+
+    def _cache_revalidated(self, uri, stale_entry):
+        # The server said the object has not changed since stale_entry was cached (304), so use that.
+        self.disk_cache.touch(uri)
+        self.metrics.record_cache('disk', self._object_type(uri), 'revalidated')
+
+        element = ElementTree.fromstring(stale_entry.data)
+        self.cache[uri] = element
+        return element
+
+    def _cache_retrieved(self, elements, uri_list, object_type):
+        # Cache the elements of a batch retrieve of uri_list as they are read, yielding each of them. The server may
+        # answer with a different uri to the one asked for (e.g. with the artifact state added), so each element is
+        # cached under both.
+        requested = {strip_state(uri): uri for uri in uri_list}
+        disk_entries = []
+
+        for element in elements:
+            uris = {element.get('uri'), requested.get(strip_state(element.get('uri')), element.get('uri'))}
+            for uri in uris:
+                self.cache[uri] = element
+            if self.disk_cache is not None:
+                data = ElementTree.tostring(element)
+                disk_entries += [(uri, data, None, None) for uri in uris]
+            yield element
+
+        if disk_entries:
+            self.disk_cache.put_many(disk_entries, object_type)
+
+    def _cache_updated(self, xml_list):
+        # The cached copies (under every uri of the objects) are out of date now the server has the new versions.
+        # They are dropped rather than replaced by the xml sent, as the server's version may differ from it (a new
+        # state, or fields the server sets), so the next read downloads it.
+        for xml in xml_list:
+            uri = xml.get('uri')
+            self.cache.discard(uri)
+            if self.disk_cache is not None:
+                self.disk_cache.delete(uri)
+
+    @staticmethod
+    def _link_uris(xml_list, tag=None):
+        # The uris of the elements that are only links (they have a uri, but not the child tag), to be downloaded.
+        return [element.get('uri') for element in xml_list if _is_link(element, tag)]
+
+    @staticmethod
+    def _replace_links(xml_list, fetched, tag=None):
+        # xml_list with the elements that are only links replaced by the linked objects among fetched.
+        fetched = {strip_state(element.get('uri')): element for element in fetched}
+        return [fetched.get(strip_state(element.get('uri')), element) if _is_link(element, tag) else element
+                for element in xml_list]
+
+
+def _is_link(element, tag=None):
+    return element.get('uri') is not None and (tag is None or element.find(tag) is None)
+
+
+class Clarity(ClarityCache):
+    def __init__(self, root, user=None, password=None, max_workers=MAX_WORKERS, disk_cache=None,
+                 cache=None, batch_size=BATCH_SIZE, max_retries=MAX_RETRIES, pool_size=None, metrics=None,
+                 record_to=None, governor=None):
         if root[-1] != '/':
             root += "/"
         self.root = root
+        self.max_workers = max_workers
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        # Keep enough idle connections for every worker thread by default.
+        self.pool_size = pool_size or max_workers
+        # Requests, batches and cache lookups are recorded here (see metrics).
+        if metrics is None:
+            metrics = exit_metrics() or Metrics()
+        self.metrics = metrics
+        # Optionally save the responses as fixtures for fake_clarity, in record_to or the CLARITY_RECORD directory.
+        self.record_to = record_to or os.environ.get('CLARITY_RECORD')
+        # Adapts the number of requests in flight at once to how the server is coping, and retries failed requests.
+        if governor is None:
+            governor = Governor(max_limit=max_workers, max_retries=max_retries, metrics=metrics)
+        self.governor = governor
 
         os_user = getpass.getuser()
         user = user or os.environ.get('USERNAME') or input("Username (leave blank for %r): " % os_user) or os_user
         password = password or os.environ.get('PASSWORD') or getpass.getpass('Password: ')
 
         self.opener = self.make_opener(user, password)
-        try:
-            # Test the credentials
+
+        def check():
             with self.opener.open(self.root):
                 pass
+
+        try:
+            # Test the credentials
+            self.governor.call(check, 'credentials check')
         except HTTPError as err:
             if err.msg == "Unauthorized":
                 sys.stderr.write("Invalid username or password\n")
+            elif err.code >= 500:
+                sys.stderr.write("Clarity is unavailable: %s\n" % err)
             else:
                 sys.stderr.write("Invalid root uri\n")
             sys.exit(1)
 
-        self.cache = {}
+        self.cache = cache if cache is not None else ElementCache(object_type=self._object_type)
+
+        # Optional persistent cache shared between runs, either passed in or named by the CLARITY_CACHE variable.
+        if disk_cache is None and os.environ.get('CLARITY_CACHE'):
+            disk_cache = DiskCache(os.environ['CLARITY_CACHE'])
+        self.disk_cache = disk_cache
+
+        # Process uri to the input uris of each of its outputs, see _inputs_by_output.
+        self._io_maps = {}
 
     def make_opener(self, user, password):
-        password_mgr = request.HTTPPasswordMgrWithDefaultRealm()
-        password_mgr.add_password(None, self.root, user, password)
-        handler = request.HTTPBasicAuthHandler(password_mgr)
-        return request.build_opener(handler)
+        opener = PooledOpener(self.root, user, password, pool_size=self.pool_size, metrics=self.metrics,
+                              governor=self.governor)
+        if self.record_to:
+            opener = RecordingOpener(opener, self.record_to, self.root)
+        return opener
 
     def get_xml(self, uri_list, use_cache=True):
         # Allow to be called with a single uri and return a single element (Not in list)
         if isinstance(uri_list, str):
             return self.get_xml([uri_list], use_cache)[0]
 
-        uri_list = list(set(uri_list))
+        elements, partitioned_uris, stale_entries = self._from_cache(uri_list, use_cache)
 
-        elements = []
+        for object_type in partitioned_uris:
+            if object_type in BATCHABLE:
+                elements += self._batch_get_xml(partitioned_uris[object_type], object_type)
+            else:
+                elements += self._concurrent_get_xml(partitioned_uris[object_type], stale_entries)
 
-        # Get all the elements you can from the cache
-        if use_cache:
-            for uri in list(uri_list):
-                if uri in self.cache:
-                    elements.append(self.cache[uri])
-                    uri_list.remove(uri)
+        return elements
 
-        # Split the uris into their object types
-        partitioned_uris = defaultdict(list)
-        for uri in uri_list:
-            # Match a string of not '/' after the root url.
-            m = re.match(self.root + '([^/]*)', uri)
-            object_type = m.group(1) if m else None
-            partitioned_uris[object_type].append(uri)
+    def get_xml_map(self, uri_list, use_cache=True):
+        # Like get_xml, but returns an OrderedDict of each uri (in the order given) to its element, so results can be
+        # matched up with the uris without searching. The artifact state is ignored when matching.
+        uri_list = list(OrderedDict.fromkeys(uri_list))
+
+        elements = {}
+        for element in self.get_xml(uri_list, use_cache):
+            elements.setdefault(element.get('uri'), element)
+            elements.setdefault(strip_state(element.get('uri')), element)
+
+        # Objects downloaded on their own are cached under the uri that was asked for, even if their own uri differs.
+        def find(uri):
+            # Elements without children are false, so test against None.
+            for element in (elements.get(uri), elements.get(strip_state(uri))):
+                if element is not None:
+                    return element
+            return self.cache.get(uri)
+
+        return OrderedDict((uri, find(uri)) for uri in uri_list)
+
+    def iter_xml(self, uri_list, use_cache=True):
+        # Like get_xml, but yields each object as soon as it has been parsed instead of waiting for every response to
+        # be complete. Batch responses are parsed incrementally, so only one chunk's objects are held at a time.
+        elements, partitioned_uris, stale_entries = self._from_cache(uri_list, use_cache)
+
+        yield from elements
 
         for object_type in partitioned_uris:
+            uris = partitioned_uris[object_type]
             if object_type in BATCHABLE:
-                elements += self._batch_get_xml(partitioned_uris[object_type], object_type)
+                for i in range(0, len(uris), self.batch_size):
+                    yield from self._iter_batch_retrieve(uris[i:i + self.batch_size], object_type)
             else:
-                for uri in partitioned_uris[object_type]:
-                    print('Downloading: ' + uri)
-                    with self.opener.open(uri) as response:
-                        self.cache[uri] = ElementTree.parse(response).getroot()
-                    elements.append(self.cache[uri])
+                yield from self._concurrent_get_xml(uris, stale_entries)
 
-        return elements
+    def _concurrent_get_xml(self, uri_list, stale_entries=None):
+        # Objects that cannot be batch retrieved are fetched one per request, so run the requests in a pool of
+        # threads. Results are returned in the same order as uri_list.
+        stale_entries = stale_entries or {}
+
+        def fetch(uri):
+            return self._single_get_xml(uri, stale_entries.get(uri))
+
+        if len(uri_list) == 1 or self.max_workers <= 1:
+            return [fetch(uri) for uri in uri_list]
+
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(uri_list))) as executor:
+            return list(executor.map(fetch, uri_list))
+
+    def _single_get_xml(self, uri, stale_entry=None):
+        req = request.Request(url=uri, headers=self._conditional_headers(stale_entry))
+
+        def download():
+            with self.opener.open(req) as response:
+                return response.read(), response.headers.get('ETag'), response.headers.get('Last-Modified')
+
+        logger.info('Downloading %s', uri)
+        try:
+            data, etag, last_modified = self.governor.call(download, uri)
+        except HTTPError as err:
+            if err.code != 304 or stale_entry is None:
+                raise
+            return self._cache_revalidated(uri, stale_entry)
+
+        return self._cache_downloaded(uri, data, etag, last_modified)
+
+    def _map_chunks(self, function, items):
+        # Split items into chunks of at most batch_size, call function on each chunk concurrently and join the
+        # results back together in order. A chunk that fails is retried on its own (see governor), without repeating
+        # the others.
+        chunks = [items[i:i + self.batch_size] for i in range(0, len(items), self.batch_size)]
+
+        def attempt(chunk):
+            return self.governor.call(lambda: function(chunk), 'batch of %d' % len(chunk))
+
+        if len(chunks) <= 1 or self.max_workers <= 1:
+            results = [attempt(chunk) for chunk in chunks]
+        else:
+            with ThreadPoolExecutor(max_workers=min(self.max_workers, len(chunks))) as executor:
+                results = list(executor.map(attempt, chunks))
+
+        return [result for chunk_results in results for result in chunk_results]
 
     def _batch_get_xml(self, uri_list, object_type):
-        print('Downloading %d %s' % (len(uri_list), object_type))
+        return self._map_chunks(lambda chunk: self._batch_retrieve(chunk, object_type), uri_list)
 
-        builder = ElementTree.TreeBuilder()
-        builder.start('ri:links', {
-            'xmlns:ri': "http://genologics.com/ri",
-        })
-        xml_element = builder.close()
+    def _batch_retrieve(self, uri_list, object_type):
+        return list(self._iter_batch_retrieve(uri_list, object_type))
 
-        for uri in uri_list:
-            child = ElementTree.TreeBuilder().start('link', {
-                'uri': uri,
-                'rel': object_type,
-            })
-            xml_element.append(child)
+    def _iter_batch_retrieve(self, uri_list, object_type):
+        logger.info('Downloading %d %s', len(uri_list), object_type)
+        self.metrics.record_batch('retrieve', object_type, len(uri_list))
 
-        req = request.Request(url=(self.root + object_type + '/batch/retrieve'), data=ElementTree.tostring(xml_element),
+        req = request.Request(url=(self.root + object_type + '/batch/retrieve'), data=links_xml(uri_list, object_type),
                               method='POST')
         req.add_header("Content-Type", "application/xml")
 
         with self.opener.open(req) as response:
-            elements = ElementTree.parse(response).getroot().getchildren()
-
-        for element in elements:
-            self.cache[element.get('uri')] = element
-
-        return elements
+            yield from self._cache_retrieved(iter_children(response), uri_list, object_type)
 
     def batch_post_xml(self, object_type, xml_list):
         if object_type not in BATCHABLE:
             raise ClarityException("Cannot batch %r" % object_type)
 
-        builder = ElementTree.TreeBuilder()
-        builder.start('ns0:details', {
-        })
-        element = builder.close()
-
-        for xml in xml_list:
-            element.append(xml)
+        return self._map_chunks(lambda chunk: self._batch_update(chunk, object_type), list(xml_list))
 
-        req = request.Request(url=(self.root + object_type + '/batch/update'), data=ElementTree.tostring(element),
+    def _batch_update(self, xml_list, object_type):
+        logger.info('Updating %d %s', len(xml_list), object_type)
+        self.metrics.record_batch('update', object_type, len(xml_list))
+        req = request.Request(url=(self.root + object_type + '/batch/update'), data=details_xml(xml_list),
                               method='POST')
         req.add_header("Content-Type", "application/xml")
 
         with self.opener.open(req) as response:
-            return ElementTree.parse(response).getroot().getchildren()
+            links = list(ElementTree.parse(response).getroot())
+
+        self._cache_updated(xml_list)
+        return links
+
+    def search(self, object_type, field, values, **filters):
+        # Search object_type for everything where field is any of values, e.g.
+        #   clarity.search('samples', 'name', uuids)
+        #   clarity.search('artifacts', 'samplelimsid', limsids, process_type='Post Lib PCR QC GetData')
+        # The values are split between as many urls as needed to keep each under MAX_URL_LENGTH, the urls are searched
+        # concurrently (following every page) and the links found are returned once each, in the order found.
+        # Underscores in filter names are sent as hyphens; a filter's value may be a list.
+        base = self.root + object_type + '?'
+        fixed = []
+        for name, filter_values in filters.items():
+            if isinstance(filter_values, str):
+                filter_values = [filter_values]
+            fixed += ['%s=%s' % (quote(name.replace('_', '-'), safe='.'), quote(value, safe=''))
+                      for value in filter_values]
+
+        uris = []
+        params = list(fixed)
+        length = len(base) + len('&'.join(fixed))
+        for value in OrderedDict.fromkeys(values):
+            param = '%s=%s' % (quote(field, safe='.'), quote(value, safe=''))
+            if len(params) > len(fixed) and length + len(param) + 1 > MAX_URL_LENGTH:
+                uris.append(base + '&'.join(params))
+                params = list(fixed)
+                length = len(base) + len('&'.join(fixed))
+            params.append(param)
+            length += len(param) + 1
+        if len(params) > len(fixed):
+            uris.append(base + '&'.join(params))
+
+        def search_uri(uri):
+            return list(self.iter_search(uri))
+
+        if len(uris) <= 1 or self.max_workers <= 1:
+            results = [search_uri(uri) for uri in uris]
+        else:
+            with ThreadPoolExecutor(max_workers=min(self.max_workers, len(uris))) as executor:
+                results = list(executor.map(search_uri, uris))
+
+        links = OrderedDict()
+        for link in (link for result in results for link in result):
+            links.setdefault(link.get('uri'), link)
+        return list(links.values())
+
+    def iter_search(self, uri, resolve=False, follow='next-page', prefetch=True):
+        # Yield every link returned by a paged list or search uri, following the next-page links (or previous-page
+        # when follow='previous-page'). The following page is downloaded in the background while the current one is
+        # being used. With resolve=True the linked objects are fetched a page at a time and yielded instead.
+        for page, next_uri in self.iter_pages(uri, follow, prefetch):
+            links = page_links(page)
+            if resolve:
+                yield from self.get_xml([link.get('uri') for link in links if link.get('uri')])
+            else:
+                yield from links
+
+    def iter_pages(self, uri, follow='next-page', prefetch=True):
+        # Yield each page of a paged list or search uri, with the uri of the page that follows it (None for the last
+        # page), as iter_search does. The following page is downloaded while the one yielded is being used.
+        visited = set()
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            page = self._get_page(uri)
+            visited.add(uri)
+
+            while page is not None:
+                next_link = page.find(follow)
+                next_uri = next_link.get('uri') if next_link is not None else None
+                if next_uri in visited:
+                    next_uri = None
+
+                next_page = None
+                if next_uri is not None:
+                    visited.add(next_uri)
+                    next_page = executor.submit(self._get_page, next_uri) if prefetch else None
+
+                yield page, next_uri
+
+                if next_uri is None:
+                    page = None
+                elif next_page is not None:
+                    page = next_page.result()
+                else:
+                    page = self._get_page(next_uri)
+
+    def get_pages(self, uri_list):
+        # Download several pages of a list or search (e.g. at different start-index values) concurrently, without
+        # following their next-page links. Returns the pages in the same order as uri_list.
+        uri_list = list(uri_list)
+        if len(uri_list) <= 1 or self.max_workers <= 1:
+            return [self._get_page(uri) for uri in uri_list]
+
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(uri_list))) as executor:
+            return list(executor.map(self._get_page, uri_list))
+
+    def _get_page(self, uri):
+        # Pages of search results are not cached, as their contents change as objects are created.
+        def download():
+            with self.opener.open(uri) as response:
+                return ElementTree.parse(response).getroot()
+
+        logger.info('Downloading %s', uri)
+        return self.governor.call(download, uri)
 
     def get_object(self, uri):
         return ClarityElement(self, [self.get_xml(uri)])
 
+    def prefetch(self, xml_list, path):
+        # Download everything that following path (e.g. 'placement/sample/project') from the elements in xml_list
+        # will need, a level at a time, so each level is one batch of requests rather than one request per element.
+        # Returns the elements at the end of the path.
+        current = list(xml_list)
+
+        for tag in path.strip('/').split('/'):
+            current = self._resolve_links(current, tag)
+            current = [child for element in current for child in element.findall(tag)]
+
+        return self._resolve_links(current)
+
+    def _resolve_links(self, xml_list, tag=None):
+        # Replace the elements that are only links (they have a uri, but not the child tag) with the linked objects.
+        links = self._link_uris(xml_list, tag)
+        return self._replace_links(xml_list, self.get_xml(links), tag) if links else xml_list
+
+    def trace(self, samples, via, to='container'):
+        # Follow the lineage of samples (sample elements or links) back through the processes of type via, e.g.
+        #   clarity.trace(samples, via='Post Lib PCR QC GetData', to='container')
+        # Finds the artifacts of the samples made by a via process, the inputs they were made from, and returns an
+        # OrderedDict of each sample uri to a list of the inputs (to='artifact'), the processes (to='process') or the
+        # containers the inputs were in (to='container'). Each generation is downloaded in one batch, or one set of
+        # concurrent requests, for all the samples at once.
+        if to not in ('artifact', 'process', 'container'):
+            raise ClarityException("Cannot trace to %r" % to)
+
+        samples = list(samples)
+        sample_uris = OrderedDict((sample.get('limsid'), sample.get('uri')) for sample in samples)
+
+        links = self.search('artifacts', 'samplelimsid', list(sample_uris), process_type=via)
+        artifacts = [artifact for artifact in self.get_xml([link.get('uri') for link in links])
+                     if artifact.find('parent-process') is not None]
+
+        processes = self.get_xml_map(artifact.find('parent-process').get('uri') for artifact in artifacts)
+
+        inputs_by_artifact = {}
+        for artifact in artifacts:
+            process_uri = artifact.find('parent-process').get('uri')
+            inputs = self._inputs_by_output(processes[process_uri]).get(strip_state(artifact.get('uri')))
+            if inputs is None:
+                # Any input would be a guess, so trace the artifact to nothing rather than to the wrong thing.
+                logger.warning('%s is not an output of its parent process %s', artifact.get('uri'), process_uri)
+                inputs = []
+            inputs_by_artifact[artifact.get('uri')] = inputs
+
+        inputs = self.get_xml_map(uri for uris in inputs_by_artifact.values() for uri in uris)
+        if to == 'container':
+            containers = self.get_xml_map(element.find('location').find('container').get('uri')
+                                          for element in inputs.values() if element.find('location') is not None)
+
+        traced = OrderedDict((sample.get('uri'), []) for sample in samples)
+        for artifact in artifacts:
+            if to == 'process':
+                targets = [processes[artifact.find('parent-process').get('uri')]]
+            else:
+                targets = [inputs[uri] for uri in inputs_by_artifact[artifact.get('uri')]]
+                if to == 'container':
+                    targets = [containers[element.find('location').find('container').get('uri')]
+                               for element in targets if element.find('location') is not None]
+
+            # Pooled artifacts belong to several samples.
+            for sample_link in artifact.findall('sample'):
+                found = traced.get(sample_uris.get(sample_link.get('limsid')))
+                if found is not None:
+                    found += [target for target in targets if not any(target is element for element in found)]
+
+        return traced
+
+    def _inputs_by_output(self, process):
+        # A dictionary of each output uri (without its state) of the process to the uris of the inputs it was made
+        # from. Worked out once per process.
+        process_uri = process.get('uri')
+        inputs_by_output = self._io_maps.get(process_uri)
+        if inputs_by_output is None:
+            inputs_by_output = OrderedDict()
+            for io_map in process.findall('input-output-map'):
+                input_link = io_map.find('input')
+                output_link = io_map.find('output')
+                if input_link is None:
+                    continue
+                output_uri = strip_state(output_link.get('uri')) if output_link is not None else None
+                inputs_by_output.setdefault(output_uri, []).append(input_link.get('uri'))
+            self._io_maps[process_uri] = inputs_by_output
+        return inputs_by_output
+
 
 class ClarityElement:
     def __init__(self, clarity, xml_list):
@@ -143,6 +663,20 @@ class ClarityElement:
         self.xml_list = xml_list
 
     def get(self, item, first=True):
+        value = self._get_local(item)
+        if value is not None:
+            return value
+
+        # If it has a url, fetch the urls and try with the fetched objects.
+        uris = self._uris()
+        if uris and first:
+            return type(self)(self.clarity, self.clarity.get_xml(uris)).get(item, first=False)
+
+        return []
+
+    def _get_local(self, item):
+        # Look for item in the elements already downloaded, returning None if it is not there.
+
         # Try the xml method
         try:
             return [getattr(xml, item) for xml in self.xml_list]
@@ -157,26 +691,39 @@ class ClarityElement:
         # Look for a child
         elements = [child for xml in self.xml_list for child in xml.findall(item)]
         if elements:
-            return ClarityElement(self.clarity, elements)
+            return type(self)(self.clarity, elements)
 
-        # If it has a url, fetch the urls and try with the fetched objects.
-        uris = [x for x in [xml.get('uri') for xml in self.xml_list] if x is not None]
-        if uris and first:
-            return ClarityElement(self.clarity, self.clarity.get_xml(uris)).get(item, first=False)
+        return None
 
-        return []
+    def _uris(self):
+        return [x for x in [xml.get('uri') for xml in self.xml_list] if x is not None]
 
     def get_first(self, item):
         values = self.get(item)
         return values[0] if values else None
 
+    def prefetch(self, path):
+        # Download every object along path (e.g. 'placement/sample/project') in one batch per level, so the
+        # get calls that follow it are served from the cache.
+        self.clarity.prefetch(self.xml_list, path)
+        return self
+
     def find(self, item):
-        return ClarityElement(self.clarity,
-                              [child for element in self.xml_list for child in element.iter() if child.tag == item])
+        return type(self)(self.clarity,
+                          [child for element in self.xml_list for child in element.iter() if child.tag == item])
 
     def get_udf(self, name):
-        return ClarityElement(self.clarity,
-                              [element for element in self.get(FIELD).xml_list if element.get('name') == name])
+        xml_list = self.xml_list
+
+        # If none of the elements have any UDFs and they have urls, fetch the urls and use the fetched objects.
+        if not any(udf_map(xml) for xml in xml_list) and self._uris():
+            xml_list = self.clarity.get_xml(self._uris())
+
+        return type(self)(self.clarity, [field for xml in xml_list for field in udf_map(xml).get(name, ())])
+
+    def to_columns(self, fields):
+        # Extract several fields from every element in one pass. See to_columns.
+        return to_columns(self.clarity._resolve_links(self.xml_list), fields)
 
     def __iter__(self):
         self.n = 0
@@ -184,7 +731,7 @@ class ClarityElement:
 
     def __next__(self):
         if self.n < len(self):
-            element = ClarityElement(self.clarity, [self.xml_list[self.n]])
+            element = type(self)(self.clarity, [self.xml_list[self.n]])
             self.n += 1
             return element
         else:
@@ -200,7 +747,7 @@ class ClarityElement:
 if __name__ == '__main__':
     clarity_class = Clarity('http://web-claritytest-01.internal.sanger.ac.uk:8080/api/v2')
 
-    container = clarity_class.get_object(clarity_class.root + 'containers/27-12105')
+    container = clarity_class.get_object(clarity_class.root + 'containers/27-12105').prefetch('placement/sample')
 
     # print(container.attrib)
     # print(container.limsid)
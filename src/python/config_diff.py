@@ -2,44 +2,157 @@
 """
 This script is used to get the difference between two xml files.
 
-usage: python list_epp.py <file1> <file2> <output_file1> <output_file2>
+usage: python config_diff.py <file1> <file2> <output_file1> <output_file2> [<diff_file>]
 
 file1 will have everything that is the same removed and be written out as output_file1. The same will be done for file2.
 Whist retaining the xml structure, only the differences between the two input files will be in the output files.
+If diff_file is given, a json list of the paths that were added, removed or changed is written to it as well.
 
 This script ignores the order of the xml, so if you care about the order of elements this will not work.
+
+diff removes the matched subtrees from the trees it is given, so no element may appear in them more than once (as it
+does in the trees get_config_tree builds, where configuration objects are shared). Use unshare to get a copy that can
+be diffed; copy.deepcopy keeps shared subtrees shared.
+
+Subtrees are compared by content hash (see canonical_xml), so identical subtrees are matched with a dictionary lookup
+and only the parts of the trees that differ are looked at in detail.
 """
 
+from collections import defaultdict
+import json
 from xml.etree import ElementTree
 import sys
 
+from canonical_xml import TreeHasher
+
 __author__ = 'rf9'
 
 
-def remove_same(node1, node2):
-    sorted1 = sorted(node1, key=lambda x: ElementTree.tostring(x))
-    sorted2 = sorted(node2, key=lambda x: ElementTree.tostring(x))
+def local_name(tag):
+    return tag.split('}')[-1]
+
+
+def element_path(parent_path, element):
+    step = local_name(element.tag)
+    if element.get('name') is not None:
+        step += '[@name=%s]' % json.dumps(element.get('name'))
+    return parent_path + '/' + step
+
+
+def header(element):
+    return element.tag, sorted(element.items()), element.text
+
+
+def unshare(tree):
+    # A copy of tree in which every element appears once, however many places it appeared in tree.
+    return ElementTree.fromstring(ElementTree.tostring(tree))
+
+
+def check_unshared(*trees):
+    # Removing a shared element from one place would remove it from all of them, and the hashes cached for the
+    # elements above them would be wrong.
+    seen = set()
+    for tree in trees:
+        for element in tree.iter():
+            if id(element) in seen:
+                raise ValueError("%s appears more than once in the trees to diff, unshare them first" % element.tag)
+            seen.add(id(element))
+
+
+def diff(node1, node2, path=None, hasher=None):
+    # Remove the subtrees that node1 and node2 have in common from both of them, and return a list of the differences
+    # found below them, each a dict with the 'change' ('added', 'removed' or 'changed') and the 'path' of the element.
+    if path is None:
+        check_unshared(node1, node2)
+        path = element_path('', node1)
+    hasher = hasher or TreeHasher()
+    changes = []
+
+    # Children of node2 that have not been matched yet, by hash.
+    unmatched2 = defaultdict(list)
+    for e2 in node2:
+        unmatched2[hasher.hash(e2)].append(e2)
+
+    # Identical subtrees are matched by hash and removed from both sides.
+    remaining1 = []
+    for e1 in list(node1):
+        same = unmatched2.get(hasher.hash(e1))
+        if same:
+            node1.remove(e1)
+            node2.remove(same.pop())
+        else:
+            remaining1.append(e1)
+
+    remaining2 = list(node2)
+
+    # Elements with the same tag, attributes and text differ somewhere below, so compare their children.
+    by_header2 = defaultdict(list)
+    for e2 in remaining2:
+        by_header2[repr(header(e2))].append(e2)
+
+    unpaired1 = []
+    paired2 = set()
+    for e1 in remaining1:
+        candidates = by_header2.get(repr(header(e1)))
+        if candidates:
+            e2 = candidates.pop(0)
+            paired2.add(id(e2))
+            changes += diff(e1, e2, element_path(path, e1), hasher)
+        else:
+            unpaired1.append(e1)
+    unpaired2 = [e2 for e2 in remaining2 if id(e2) not in paired2]
+
+    # Elements with the same tag and name but different attributes or text have been changed, the rest were added or
+    # removed.
+    by_name2 = defaultdict(list)
+    for e2 in unpaired2:
+        by_name2[(e2.tag, e2.get('name'))].append(e2)
+
+    changed2 = set()
+    for e1 in unpaired1:
+        candidates = by_name2.get((e1.tag, e1.get('name')))
+        if candidates:
+            e2 = candidates.pop(0)
+            changed2.add(id(e2))
+            changes.append({
+                'change': 'changed',
+                'path': element_path(path, e1),
+                'before': {'attributes': dict(e1.items()), 'text': e1.text},
+                'after': {'attributes': dict(e2.items()), 'text': e2.text},
+            })
+        else:
+            changes.append({'change': 'removed', 'path': element_path(path, e1)})
+
+    changes += [{'change': 'added', 'path': element_path(path, e2)} for e2 in unpaired2 if id(e2) not in changed2]
+
+    return changes
 
-    for e1 in sorted1:
-        for e2 in sorted2:
-            if e1.tag == e2.tag and e1.items() == e2.items() and e1.text == e2.text and e2 in node2:
-                if remove_same(e1, e2):
-                    node1.remove(e1)
-                    node2.remove(e2)
-                    break
 
-    if not list(node1) and not list(node2):
-        if node1.tag == node2.tag and node1.items() == node2.items() and node1.text == node2.text:
-            return True
+def remove_same(node1, node2):
+    # Remove everything node1 and node2 have in common from both, returning True if they were the same.
+    changes = diff(node1, node2)
+    return not changes and header(node1) == header(node2)
+
 
-    return False
+def compare(tree1, tree2):
+    # Like diff, but for two whole trees, so a difference between the roots themselves is reported too.
+    changes = diff(tree1, tree2)
+    if header(tree1) != header(tree2):
+        changes.insert(0, {'change': 'changed', 'path': element_path('', tree1)})
+    return changes
 
 
-def main(in_file_1, in_file_2, out_file_1, out_file_2):
+def main(in_file_1, in_file_2, out_file_1, out_file_2, diff_file=None):
     tree1 = ElementTree.parse(in_file_1).getroot()
     tree2 = ElementTree.parse(in_file_2).getroot()
 
-    if not remove_same(tree1, tree2):
+    changes = compare(tree1, tree2)
+
+    if diff_file is not None:
+        with open(diff_file, mode='w') as out_file:
+            json.dump(changes, out_file, indent=2)
+
+    if changes:
         with open(out_file_1, mode='w') as out_file:
             out_file.write(ElementTree.tostring(tree1).decode('ascii'))
 
@@ -52,13 +165,14 @@ def main(in_file_1, in_file_2, out_file_1, out_file_2):
 
 
 if __name__ == "__main__":
-    if len(sys.argv) == 5:
+    if len(sys.argv) in (5, 6):
         in1 = sys.argv[1]
         in2 = sys.argv[2]
         out1 = sys.argv[3]
         out2 = sys.argv[4]
+        diff_out = sys.argv[5] if len(sys.argv) == 6 else None
     else:
-        sys.stderr.write("usage: python config_diff.py <file1> <file2> <output_file1> <output_file2>\n")
+        sys.stderr.write("usage: python config_diff.py <file1> <file2> <output_file1> <output_file2> [<diff_file>]\n")
         sys.exit(1)
 
-    main(in1, in2, out1, out2)
+    main(in1, in2, out1, out2, diff_out)
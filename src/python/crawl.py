@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+"""
+Long walks through the pages of a Clarity list or search that carry on where they stopped when they are run again.
+
+    crawl = Crawl(clarity, 'missing_reagents.journal', clarity.root + 'artifacts?process-type=Library%20PCR%20set%20up')
+    for artifact in crawl.iter(resolve=True):
+        check(artifact)
+
+The journal (an SQLite file, which can hold any number of crawls) records the page each crawl is on and every object
+it has finished with. An object is finished with once the loop asks for the next one, so one that the loop was working
+on when the script was stopped (by an error, ^C or being killed) is done again next time, but nothing else is. When the
+crawl is run again it starts from the page it was on, skips the objects already finished with (without downloading
+them, with resolve=True) and moves on. Once every page has been done the crawl is finished, and yields nothing more
+until it is restarted.
+
+The pages are walked with Clarity.iter_pages, so the next page is downloaded in the background while the objects on the
+current one are being worked on, as with Clarity.iter_search.
+"""
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from cache import select_in
+from clarity import page_links
+
+__author__ = 'rf9'
+
+
+class Crawl:
+    def __init__(self, clarity, journal_path, uri, follow='next-page', name=None):
+        self.clarity = clarity
+        self.uri = uri
+        self.follow = follow
+        # Crawls of the same uri in the same direction share their progress, unless they are given names.
+        self.name = name or '%s %s' % (follow, uri)
+
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(journal_path, check_same_thread=False)
+        # Every object finished with is committed on its own, which is cheap with a write-ahead log.
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        with self._connection:
+            self._connection.execute('CREATE TABLE IF NOT EXISTS journal ('
+                                     'name TEXT PRIMARY KEY, '
+                                     'page TEXT, '
+                                     'pages INTEGER NOT NULL, '
+                                     'finished INTEGER NOT NULL, '
+                                     'updated REAL NOT NULL)')
+            self._connection.execute('CREATE TABLE IF NOT EXISTS journal_done ('
+                                     'name TEXT, '
+                                     'uri TEXT, '
+                                     'PRIMARY KEY (name, uri)) WITHOUT ROWID')
+
+    def state(self):
+        # The uri of the page the crawl is on (None before it has started), the number of pages done and whether it
+        # has finished.
+        with self._lock:
+            row = self._connection.execute('SELECT page, pages, finished FROM journal WHERE name = ?',
+                                           (self.name,)).fetchone()
+        if row is None:
+            return None, 0, False
+        return row[0], row[1], bool(row[2])
+
+    def __len__(self):
+        # The number of objects finished with.
+        with self._lock:
+            return self._connection.execute('SELECT COUNT(*) FROM journal_done WHERE name = ?',
+                                            (self.name,)).fetchone()[0]
+
+    def restart(self):
+        # Forget the progress of the crawl, so that it starts again from the beginning.
+        with self._lock, self._connection:
+            self._connection.execute('DELETE FROM journal WHERE name = ?', (self.name,))
+            self._connection.execute('DELETE FROM journal_done WHERE name = ?', (self.name,))
+
+    def is_done(self, uri):
+        return bool(self._done_among([uri]))
+
+    def _done_among(self, uris):
+        # The uris that have been finished with.
+        with self._lock:
+            rows = select_in(self._connection, 'SELECT uri FROM journal_done WHERE name = ? AND uri IN (%s)', uris,
+                             [self.name])
+        return {uri for (uri,) in rows}
+
+    def done(self, uri):
+        # Record that the object at uri has been finished with.
+        with self._lock, self._connection:
+            self._connection.execute('INSERT OR IGNORE INTO journal_done VALUES (?, ?)', (self.name, uri))
+
+    def _move_to(self, page, pages, finished):
+        with self._lock, self._connection:
+            self._connection.execute('INSERT OR REPLACE INTO journal VALUES (?, ?, ?, ?, ?)',
+                                     (self.name, page, pages, int(finished), time.time()))
+
+    def iter(self, resolve=False):
+        # Yield every link on every page that has not been finished with, or the objects they link to if resolve is
+        # True (downloaded a page at a time).
+        page_uri, pages, finished = self.state()
+        if finished:
+            return
+        page_uri = page_uri or self.uri
+        self._move_to(page_uri, pages, False)
+
+        for page, next_uri in self.clarity.iter_pages(page_uri, self.follow):
+            links = [link for link in page_links(page) if link.get('uri')]
+            done = self._done_among(link.get('uri') for link in links)
+            links = OrderedDict((link.get('uri'), link) for link in links if link.get('uri') not in done)
+
+            if resolve and links:
+                items = self.clarity.get_xml_map(links).items()
+            else:
+                items = links.items()
+
+            for uri, item in items:
+                yield item
+                # Only reached when the loop asks for the next object, so it has finished with this one.
+                self.done(uri)
+
+            pages += 1
+            page_uri = next_uri or page_uri
+            self._move_to(page_uri, pages, next_uri is None)
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
@@ -0,0 +1,406 @@
+#!/usr/bin/env python3
+"""
+A stand-in for the Clarity API serving recorded or made up objects, so that scripts can be run and timed without a LIMS.
+
+usage: python fake_clarity.py <fixture_directory> [--port=<port>] [--latency=<seconds>] [--item-latency=<seconds>]
+                              [--error-rate=<fraction>] [--page-size=<n>] [--seed=<n>]
+
+It serves, under http://localhost:<port>/api/v2/:
+    * every object in the fixture directory (see fixtures, and CLARITY_RECORD for recording them from a real server),
+    * searches: the recorded response if there is one, otherwise the objects of the type that match the name, limsid,
+      udf.<name>, samplelimsid, type, process-type and inputartifactlimsid parameters (values of the same parameter are
+      ORed, different parameters ANDed), page-size at a time with next-page and previous-page links,
+    * <type>/batch/retrieve and <type>/batch/update, and PUT of single objects. Updates are kept in memory only.
+
+Every request waits for latency seconds (plus item-latency for each object in a batch) before it is answered, and a
+random error-rate of them fail with a 503, except for the root which Clarity uses to check the credentials. Any user
+name and password are accepted.
+
+From python, FakeClarity(...).start() runs the server in a background thread; its root attribute is the root uri to
+give Clarity, add() and add_at() add made up objects and requests counts the requests made, by method and endpoint.
+"""
+import os
+import random
+import re
+import threading
+import time
+from collections import Counter, OrderedDict, defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, quote, urlencode, urlsplit
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape, quoteattr
+
+import sys
+
+from cache import strip_state, udf_map
+from fixtures import ROOT_FILE, fixture_path
+from metrics import endpoint
+
+__author__ = 'rf9'
+
+API_PATH = '/api/v2/'
+PAGE_SIZE = 500
+XML_DECLARATION = re.compile(br'^\s*<\?xml[^>]*\?>\s*')
+# The tag of the links in a list of objects of each type.
+LINK_TAGS = {
+    'artifacts': 'artifact',
+    'containers': 'container',
+    'files': 'file',
+    'processes': 'process',
+    'projects': 'project',
+    'researchers': 'researcher',
+    'samples': 'sample',
+}
+
+
+class ClarityError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+def _link_tag(object_type):
+    return LINK_TAGS.get(object_type, object_type.rstrip('s'))
+
+
+def _exception_xml(message):
+    return ('<exc:exception xmlns:exc="http://genologics.com/ri/exception"><message>%s</message></exc:exception>' %
+            escape(message)).encode('utf-8')
+
+
+def _strip_declaration(data):
+    return XML_DECLARATION.sub(b'', data)
+
+
+class FakeClarity:
+    def __init__(self, fixtures=None, port=0, latency=0, item_latency=0, error_rate=0, page_size=PAGE_SIZE, seed=None,
+                 host='localhost'):
+        self.latency = latency
+        self.item_latency = item_latency
+        self.error_rate = error_rate
+        self.page_size = page_size
+
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        # Fixture path (without any artifact state) to the xml of the object, and to its parsed element once needed.
+        self._objects = OrderedDict()
+        self._elements = {}
+        self._searches = {}
+        self._recorded_root = None
+
+        self.requests = Counter()
+        self.errors = 0
+
+        self._server = ThreadingHTTPServer((host, port), _Handler)
+        self._server.daemon_threads = True
+        self._server.fake = self
+        self.root = 'http://%s:%d%s' % (host, self._server.server_port, API_PATH)
+        self._thread = None
+
+        if fixtures is not None:
+            self.load(fixtures)
+
+    def load(self, directory):
+        root_path = os.path.join(directory, ROOT_FILE)
+        if os.path.exists(root_path):
+            with open(root_path) as root_file:
+                self._recorded_root = root_file.read().strip().encode('utf-8')
+
+        for (path, subdirectories, filenames) in os.walk(os.path.join(directory, 'GET')):
+            for filename in filenames:
+                full_path = os.path.join(path, filename)
+                with open(full_path, 'rb') as in_file:
+                    data = self._to_local(in_file.read())
+
+                key = os.path.relpath(full_path, directory)
+                if '?' in key and '?state=' not in key:
+                    self._searches[key] = data
+                else:
+                    self._objects[strip_state(key)] = data
+
+    def _to_local(self, data):
+        # Objects recorded from another server are served with their uris changed to this one.
+        data = _strip_declaration(data)
+        if self._recorded_root:
+            data = data.replace(self._recorded_root, self.root.encode('utf-8'))
+        return data
+
+    def _key(self, uri):
+        return strip_state(fixture_path(self.root, 'GET', uri))
+
+    def add(self, *xml_list):
+        # Add objects (elements, or xml as bytes or str) to be served, under their uri attributes.
+        for xml in xml_list:
+            element = ElementTree.fromstring(xml) if isinstance(xml, (bytes, str)) else xml
+            self._store(self._key(element.get('uri')), ElementTree.tostring(element), element)
+
+    def add_at(self, uri, xml):
+        # Serve an object at uri rather than its own uri, e.g. a list such as configuration/workflows, which has none.
+        element = ElementTree.fromstring(xml) if isinstance(xml, (bytes, str)) else xml
+        self._store(self._key(uri), ElementTree.tostring(element), element)
+
+    def _store(self, key, data, element=None):
+        with self._lock:
+            self._objects[key] = data
+            self._elements.pop(key, None)
+            if element is not None:
+                self._elements[key] = element
+
+    def _element(self, key):
+        with self._lock:
+            element = self._elements.get(key)
+            data = self._objects.get(key)
+        if element is None and data is not None:
+            element = ElementTree.fromstring(data)
+            with self._lock:
+                self._elements[key] = element
+        return element
+
+    def __len__(self):
+        return len(self._objects)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def serve_forever(self):
+        try:
+            self._server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self._server.server_close()
+
+    def _delay(self, items=0):
+        delay = self.latency + self.item_latency * items
+        if delay > 0:
+            time.sleep(delay)
+
+    def _should_fail(self):
+        if not self.error_rate:
+            return False
+        with self._lock:
+            failed = self._random.random() < self.error_rate
+            if failed:
+                self.errors += 1
+        return failed
+
+    def handle(self, method, path, body):
+        # Answer a request, returning the status and the body of the response.
+        url = self.root + path[len(API_PATH):] if path.startswith(API_PATH) else self.root + path.lstrip('/')
+        with self._lock:
+            self.requests[method, endpoint(self.root, url)[0]] += 1
+
+        relative = url[len(self.root):]
+        if not relative:
+            self._delay()
+            return 200, b'<ver:versions xmlns:ver="http://genologics.com/ri/version"/>'
+
+        if self._should_fail():
+            self._delay()
+            raise ClarityError(503, 'Service temporarily unavailable (injected error)')
+
+        object_type = relative.split('/')[0].split('?')[0]
+        if method == 'GET':
+            self._delay()
+            # A list of every object of a type (e.g. artifacts) is a search with no filters.
+            is_list = '/' not in relative.split('?')[0].strip('/')
+            is_search = '?' in relative and not re.search(r'\?state=\d+$', relative)
+            if is_list or is_search:
+                return 200, self.search(url)
+            return 200, self.get(url)
+
+        if method == 'POST' and relative.endswith('/batch/retrieve'):
+            links = ElementTree.fromstring(body)
+            self._delay(len(links))
+            return 200, self.batch_retrieve(object_type, [link.get('uri') for link in links])
+
+        if method == 'POST' and relative.endswith('/batch/update'):
+            details = ElementTree.fromstring(body)
+            self._delay(len(details))
+            return 200, self.batch_update(object_type, list(details))
+
+        if method == 'PUT':
+            self._delay(1)
+            element = ElementTree.fromstring(body)
+            if self._key(url) not in self._objects:
+                raise ClarityError(404, 'No %s at %s' % (object_type, url))
+            self._store(self._key(url), ElementTree.tostring(element), element)
+            return 200, ElementTree.tostring(element)
+
+        raise ClarityError(405, '%s is not supported for %s' % (method, url))
+
+    def get(self, url):
+        with self._lock:
+            data = self._objects.get(self._key(url))
+        if data is None:
+            raise ClarityError(404, 'Nothing at %s' % url)
+        return data
+
+    def batch_retrieve(self, object_type, uris):
+        parts = [b'<ri:details xmlns:ri="http://genologics.com/ri">']
+        for uri in uris:
+            parts.append(self.get(uri))
+        parts.append(b'</ri:details>')
+        return b''.join(parts)
+
+    def batch_update(self, object_type, elements):
+        for element in elements:
+            key = self._key(element.get('uri'))
+            if key not in self._objects:
+                raise ClarityError(404, 'No %s at %s' % (object_type, element.get('uri')))
+
+        links = []
+        for element in elements:
+            self._store(self._key(element.get('uri')), ElementTree.tostring(element), element)
+            links.append('<link uri=%s rel=%s/>' % (quoteattr(element.get('uri')), quoteattr(object_type)))
+        return ('<ri:links xmlns:ri="http://genologics.com/ri">%s</ri:links>' % ''.join(links)).encode('utf-8')
+
+    def search(self, url):
+        recorded = self._searches.get(fixture_path(self.root, 'GET', url))
+        if recorded is not None:
+            return recorded
+
+        parts = urlsplit(url)
+        object_type = parts.path[len(API_PATH):].strip('/')
+        params = parse_qsl(parts.query, keep_blank_values=True)
+
+        start = 0
+        filters = defaultdict(set)
+        for name, value in params:
+            if name == 'start-index':
+                start = int(value)
+            else:
+                filters[name].add(value)
+
+        matchers = [self._matcher(name, values) for name, values in filters.items()]
+
+        prefix = os.path.join('GET', object_type + '.')
+        with self._lock:
+            keys = [key for key in self._objects if key.startswith(prefix)]
+        matches = []
+        for key in keys:
+            element = self._element(key)
+            if all(matcher(element) for matcher in matchers):
+                matches.append(element)
+
+        tag = _link_tag(object_type)
+        body = ['<%s:%s xmlns:%s="http://genologics.com/ri/%s">' % (tag, object_type, tag, tag)]
+        for element in matches[start:start + self.page_size]:
+            body.append('<%s uri=%s limsid=%s/>' % (tag, quoteattr(element.get('uri')),
+                                                     quoteattr(element.get('limsid') or '')))
+
+        def page_uri(page_start):
+            query = urlencode([(name, value) for name, value in params if name != 'start-index'] +
+                              [('start-index', page_start)], quote_via=quote)
+            return self.root + object_type + '?' + query
+
+        if start > 0:
+            body.append('<previous-page uri=%s/>' % quoteattr(page_uri(max(0, start - self.page_size))))
+        if start + self.page_size < len(matches):
+            body.append('<next-page uri=%s/>' % quoteattr(page_uri(start + self.page_size)))
+        body.append('</%s:%s>' % (tag, object_type))
+        return ''.join(body).encode('utf-8')
+
+    def _matcher(self, name, values):
+        # A function that is True for the elements that match any of values for the search parameter name.
+        if name == 'name':
+            return lambda element: element.findtext('name') in values
+        if name == 'limsid':
+            return lambda element: element.get('limsid') in values
+        if name == 'type':
+            return lambda element: element.findtext('type') in values
+        if name.startswith('udf.'):
+            udf_name = name[len('udf.'):]
+            return lambda element: any(field.text in values for field in udf_map(element).get(udf_name, ()))
+        if name == 'samplelimsid':
+            return lambda element: any(sample.get('limsid') in values for sample in element.findall('sample'))
+        if name == 'inputartifactlimsid':
+            return lambda element: any(input_link.get('limsid') in values
+                                       for input_link in element.findall('input-output-map/input'))
+        if name == 'process-type':
+            def matches(element):
+                parent = element.find('parent-process')
+                if parent is None:
+                    return False
+                process = self._element(self._key(parent.get('uri')))
+                return process is not None and process.findtext('type') in values
+            return matches
+
+        raise ClarityError(400, 'Unsupported search parameter %r' % name)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # The headers and body are written separately, so without this the body of every response waits for the client to
+    # acknowledge the headers.
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def _answer(self, method):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else None
+
+        try:
+            status, data = self.server.fake.handle(method, self.path, body)
+        except ClarityError as err:
+            status = err.status
+            data = _exception_xml(err.message)
+        except ElementTree.ParseError as err:
+            status = 400
+            data = _exception_xml(str(err))
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/xml')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        self._answer('GET')
+
+    def do_POST(self):
+        self._answer('POST')
+
+    def do_PUT(self):
+        self._answer('PUT')
+
+
+if __name__ == '__main__':
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    options = dict(arg[2:].split('=', 1) for arg in sys.argv[1:] if arg.startswith('--') and '=' in arg)
+
+    if len(args) == 1:
+        fixture_directory = args[0]
+    else:
+        sys.stderr.write("usage: python fake_clarity.py <fixture_directory> [--port=<port>] [--latency=<seconds>] "
+                         "[--item-latency=<seconds>] [--error-rate=<fraction>] [--page-size=<n>] [--seed=<n>]\n")
+        sys.exit(1)
+
+    fake = FakeClarity(fixture_directory,
+                       port=int(options.get('port', 8080)),
+                       latency=float(options.get('latency', 0)),
+                       item_latency=float(options.get('item-latency', 0)),
+                       error_rate=float(options.get('error-rate', 0)),
+                       page_size=int(options.get('page-size', PAGE_SIZE)),
+                       seed=int(options['seed']) if 'seed' in options else None)
+
+    print('Serving %d objects at %s' % (len(fake), fake.root))
+    fake.serve_forever()
+
+    for (method, endpoint_name), count in sorted(fake.requests.items()):
+        print('%6d %s %s' % (count, method, endpoint_name))
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""
+Recorded Clarity responses (fixtures), for fake_clarity to serve.
+
+Fixtures are laid out like the web cache of the perl code (wtsi_clarity::util::request): one file per response under
+<directory>/<method>/, named from the path after the root with its last two parts joined by a '.', e.g.
+    GET/artifacts.2-1234?state=5678
+    GET/configuration/protocols/1/steps.2
+    GET/artifacts?samplelimsid=SMI1&process-type=Post%20Lib%20PCR%20QC%20GetData
+The root the responses were recorded from is kept in <directory>/ROOT, so that they can be served from another one.
+
+To record, pass record_to=<directory> to Clarity or set the CLARITY_RECORD environment variable to the directory. Every
+GET response is then saved, and so is every object in a batch retrieve response (as if it had been fetched on its own),
+as the script runs. Updates are not recorded.
+"""
+import hashlib
+import io
+import os
+import re
+import threading
+from urllib.request import Request
+from xml.etree import ElementTree
+
+__author__ = 'rf9'
+
+ROOT_FILE = 'ROOT'
+
+
+def fixture_path(root, method, url, content=None):
+    # The path of the fixture for a request, relative to the fixture directory, or None for the root itself.
+    short_url = url[len(root):] if url.startswith(root) else re.sub(r'^https?://[^/]+', '', url)
+    components = short_url.replace('//', '/').split('/')
+
+    # A batch retrieve is named after the md5 of the request rather than 'retrieve'.
+    if len(components) >= 2 and components[-2:] == ['batch', 'retrieve']:
+        components.pop()
+    if content:
+        components[-1] += '_' + hashlib.md5(content).hexdigest()
+
+    components = [component for component in [method] + components if component]
+    if len(components) < 2:
+        return None
+    if len(components) > 2:
+        resource_id = components.pop()
+        components[-1] += '.' + resource_id
+    return os.path.join(*components)
+
+
+class RecordedResponse:
+    # A response whose body has already been read, as returned by RecordingOpener.
+    def __init__(self, response, data):
+        self.status = self.code = response.status
+        self.reason = self.msg = response.reason
+        self.headers = response.headers
+        self._body = io.BytesIO(data)
+
+    def read(self, size=-1):
+        return self._body.read(-1 if size is None else size)
+
+    def readable(self):
+        return True
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class RecordingOpener:
+    # Wraps an opener (see transport.PooledOpener), saving the responses it gets as fixtures in directory.
+    def __init__(self, opener, directory, root):
+        self._opener = opener
+        self.directory = directory
+        self.root = root
+        self._lock = threading.Lock()
+
+        os.makedirs(directory, exist_ok=True)
+        root_path = os.path.join(directory, ROOT_FILE)
+        if not os.path.exists(root_path):
+            with open(root_path, 'w') as root_file:
+                root_file.write(root + '\n')
+
+    def open(self, url, data=None):
+        req = url if isinstance(url, Request) else Request(url, data=data)
+
+        with self._opener.open(req) as response:
+            body = response.read()
+
+        if req.get_method() == 'GET':
+            self._write(fixture_path(self.root, 'GET', req.full_url), body)
+        elif req.full_url.endswith('/batch/retrieve'):
+            for element in ElementTree.fromstring(body):
+                self._write(fixture_path(self.root, 'GET', element.get('uri')), ElementTree.tostring(element))
+
+        return RecordedResponse(response, body)
+
+    def _write(self, path, body):
+        if path is None:
+            return
+
+        path = os.path.join(self.directory, path)
+        with self._lock:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary_path = '%s.%d.tmp' % (path, threading.get_ident())
+        with open(temporary_path, 'wb') as out_file:
+            out_file.write(body)
+        os.replace(temporary_path, path)
+
+    def close(self):
+        self._opener.close()
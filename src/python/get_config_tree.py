@@ -8,58 +8,91 @@ Root url is the url that ends in `/api/v2`
 
 Use with config_diff.py to get the differences between two xml configs.
 """
+import logging
+from collections import OrderedDict
 from urllib.parse import urljoin
 from xml.etree import ElementTree
 
 import sys
 
+from canonical_xml import TreeHasher, canonical_sort
 from clarity import Clarity
 
 __author__ = 'rf9'
 
-IGNORE_LIST = ['stage']
-
-
-def main(clarity, out_file_path):
-    def expand(element_to_expand):
-        uri = element_to_expand.get('uri')
-
-        if 'uri' in element_to_expand.attrib:
-            del element_to_expand.attrib['uri']
-        if 'protocol-uri' in element_to_expand.attrib:
-            del element_to_expand.attrib['protocol-uri']
-        if 'next-step-uri' in element_to_expand.attrib:
-            del element_to_expand.attrib['next-step-uri']
-
-        if element_to_expand.tag in IGNORE_LIST:
-            return
-
-        if uri and element_to_expand is not None:
-            for child_element in clarity.get_xml(uri):
-                element_to_expand.append(child_element)
-
-        for child_element in element_to_expand:
-            expand(child_element)
+logger = logging.getLogger(__name__)
 
-    def sort_tree(tree):
-        for child_element in tree:
-            sort_tree(child_element)
-
-        children_elements = sorted(tree, key=lambda x: ElementTree.tostring(x))
-        for child_element in children_elements:
-            tree.remove(child_element)
-            tree.append(child_element)
-
-    workflows = clarity.get_xml(urljoin(clarity.root, 'configuration/workflows/'))
+IGNORE_LIST = ['stage']
+LINK_ATTRIBUTES = ['uri', 'protocol-uri', 'next-step-uri']
+
+
+def expand(clarity, root_element, manifest=None):
+    # Replace every link in the tree with the contents of the object it links to, a level of the tree at a time.
+    # Every uri on a level is downloaded at once (concurrently), and each object is only downloaded and expanded once
+    # however many times it is linked to: its children are grafted under every link to it.
+    # If manifest is given, the content hash of each object (as downloaded, before it is expanded) is added to it by uri.
+    # Returns the number of objects downloaded and the number of links to them.
+    children_by_uri = {}
+    references = 0
+    visited = set()
+
+    level = [root_element]
+    while level:
+        links = []
+        for element in level:
+            uri = element.get('uri')
+
+            for attribute in LINK_ATTRIBUTES:
+                if attribute in element.attrib:
+                    del element.attrib[attribute]
+
+            if element.tag not in IGNORE_LIST and uri:
+                links.append((element, uri))
+
+        new_uris = list(OrderedDict.fromkeys(uri for element, uri in links if uri not in children_by_uri))
+        for uri, fetched in clarity.get_xml_map(new_uris).items():
+            children_by_uri[uri] = list(fetched)
+            if manifest is not None:
+                manifest[uri] = TreeHasher().hexdigest(fetched)
+
+        references += len(links)
+        for element, uri in links:
+            for child_element in children_by_uri[uri]:
+                element.append(child_element)
+
+        # Shared children are only expanded the first time they are seen.
+        next_level = []
+        for element in level:
+            if element.tag in IGNORE_LIST:
+                continue
+            for child_element in element:
+                if id(child_element) not in visited:
+                    visited.add(id(child_element))
+                    next_level.append(child_element)
+        level = next_level
+
+    return len(children_by_uri), references
+
+
+def get_tree(clarity, manifest=None):
+    # The list of workflows is always downloaded again, as it is what says which workflows are active.
+    workflows = clarity.get_xml(urljoin(clarity.root, 'configuration/workflows/'), use_cache=False)
 
     for workflow in workflows.findall('workflow'):
         if workflow.get('status') != 'ACTIVE':
             workflows.remove(workflow)
 
-    expand(workflows)
+    fetched, references = expand(clarity, workflows, manifest)
+    logger.info('Downloaded %d configuration objects for %d links', fetched, references)
+
+    # Put the xml in a canonical order (retaining structure) to avoid false changes in the diff.
+    canonical_sort(workflows)
 
-    # Alphabetise the xml (retaining structure) to avoid false changes in the diff.
-    sort_tree(workflows)
+    return workflows
+
+
+def main(clarity, out_file_path):
+    workflows = get_tree(clarity)
 
     with open(out_file_path, 'w') as out_file:
         out_file.write(ElementTree.tostring(workflows).decode('ascii'))
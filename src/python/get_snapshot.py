@@ -1,26 +1,96 @@
 #!/usr/bin/env python3
+"""
+Snapshot the workflow configuration of several Clarity servers at once and compare them.
+
+usage: python get_snapshot.py [--pairwise] <root_uri_test> <root_uri_prod>
+       python get_snapshot.py [--pairwise] <name>=<root_uri> <name>=<root_uri> [<name>=<root_uri> ...]
+
+The servers are named test and prod when two bare uris are given (as before), or by the names given with them, e.g.
+dev=https://dev/api/v2/ test=https://test/api/v2/ prod=https://prod/api/v2/.
+
+The credentials for every server are asked for first (USERNAME and PASSWORD are not used, as they would be the same for
+every server), then all the servers are snapshotted at the same time, each with its own Clarity client. Each snapshot
+is written to snapshots/<date>_<name>.xml.
+
+By default every server is compared to the first one (the baseline), or with --pairwise every server is compared to
+every other one. For each pair that differs, the parts of the two configurations that differ are written to
+snapshots/<date>_<name>_diff.xml files (as config_diff does), prefixed with both names if there is more than one pair.
+The number of differences between each pair is printed as a matrix and written to snapshots/<date>_drift.json with the
+list of differences.
+"""
 
 import datetime
 import getpass
+import itertools
+import json
 import os
+from concurrent.futures import ThreadPoolExecutor
+from xml.etree import ElementTree
 
 import sys
 
 import get_config_tree
 import config_diff
 
+from canonical_xml import TreeHasher
 from clarity import Clarity
 
 __author__ = 'rf9'
 
 DIRECTORY = 'snapshots'
 
+
+def parse_instances(args):
+    # Returns a list of (name, root uri), in the order given.
+    if len(args) == 2 and not any('=' in arg for arg in args):
+        return [('test', args[0]), ('prod', args[1])]
+
+    instances = []
+    for arg in args:
+        name, _, root = arg.partition('=')
+        if not root:
+            raise ValueError("%r should be <name>=<root_uri>" % arg)
+        instances.append((name, root))
+    return instances
+
+
+def compare(tree1, tree2):
+    # A list of the differences between two trees, leaving both trees unchanged. Returns the copies that only have the
+    # differences left in them too, or None if there are none.
+    hasher = TreeHasher()
+    if hasher.hash(tree1) == hasher.hash(tree2):
+        return [], None
+
+    # Copies without the shared subtrees of get_config_tree, which deepcopy would keep shared.
+    tree1 = config_diff.unshare(tree1)
+    tree2 = config_diff.unshare(tree2)
+    return config_diff.compare(tree1, tree2), (tree1, tree2)
+
+
+def print_matrix(names, drift):
+    width = max(len(name) for name in names) + 2
+    print(''.join(name.rjust(width) for name in [''] + names))
+    for name1 in names:
+        row = [drift[name1].get(name2, drift[name2].get(name1)) for name2 in names]
+        print(name1.rjust(width) + ''.join(('-' if count is None else str(count)).rjust(width) for count in row))
+
+
 if __name__ == "__main__":
-    if len(sys.argv) == 3:
-        root_url_test = sys.argv[1]
-        root_url_prod = sys.argv[2]
-    else:
-        sys.stderr.write("usage: python get_snapshot.py <root_uri_test> <root_uri_prod>\n")
+    args = sys.argv[1:]
+    pairwise = '--pairwise' in args
+    if pairwise:
+        args.remove('--pairwise')
+
+    try:
+        instances = parse_instances(args)
+    except ValueError as err:
+        sys.stderr.write("%s\n" % err)
+        instances = []
+
+    names = [name for name, root in instances]
+    if len(instances) < 2 or len(set(names)) != len(names):
+        sys.stderr.write("usage: python get_snapshot.py [--pairwise] <root_uri_test> <root_uri_prod>\n"
+                         "       python get_snapshot.py [--pairwise] <name>=<root_uri> <name>=<root_uri> ...\n")
         sys.exit(1)
 
     date = str(datetime.datetime.now()).replace(' ', '_')
@@ -28,24 +98,44 @@ if __name__ == "__main__":
     if not os.path.exists(DIRECTORY):
         os.makedirs(DIRECTORY)
 
-    test_file = '%s/%s_test.xml' % (DIRECTORY, date)
-    prod_file = '%s/%s_prod.xml' % (DIRECTORY, date)
-    test_file_diff = '%s/%s_test_diff.xml' % (DIRECTORY, date)
-    prod_file_diff = '%s/%s_prod_diff.xml' % (DIRECTORY, date)
+    # Credentials have to be asked for one at a time, and always are, as USERNAME and PASSWORD would give every server
+    # the same ones.
+    clients = []
+    for name, root in instances:
+        print('Input %s credentials:' % name)
+        user = getpass.getuser()
+        user = input("Username (leave blank for %r): " % user) or user
+        password = getpass.getpass('Password: ')
+        clients.append(Clarity(root, user, password))
+
+    with ThreadPoolExecutor(max_workers=len(clients)) as executor:
+        trees = dict(zip(names, executor.map(get_config_tree.get_tree, clients)))
+
+    for name, tree in trees.items():
+        with open('%s/%s_%s.xml' % (DIRECTORY, date, name), 'w') as out_file:
+            out_file.write(ElementTree.tostring(tree).decode('ascii'))
+
+    if pairwise:
+        pairs = list(itertools.combinations(names, 2))
+    else:
+        pairs = [(names[0], name) for name in names[1:]]
 
-    print('Input test credentials:')
-    test_user = getpass.getuser()
-    test_user = input("Username (leave blank for %r): " % test_user) or test_user
-    test_password = getpass.getpass('Password: ')
-    test_clarity = Clarity(root_url_test, test_user, test_password)
+    drift = {name: {name: 0} for name in names}
+    differences = []
+    for name1, name2 in pairs:
+        changes, diff_trees = compare(trees[name1], trees[name2])
+        drift[name1][name2] = len(changes)
+        differences.append({'from': name1, 'to': name2, 'changes': changes})
 
-    print('Input production credentials:')
-    prod_user = getpass.getuser()
-    prod_user = input("Username (leave blank for %r): " % prod_user) or prod_user
-    prod_password = getpass.getpass('Password: ')
-    prod_clarity = Clarity(root_url_prod, prod_user, prod_password)
+        if diff_trees is not None:
+            prefix = '%s/%s_' % (DIRECTORY, date)
+            if len(pairs) > 1:
+                prefix += '%s_%s_' % (name1, name2)
+            for name, tree in zip((name1, name2), diff_trees):
+                with open('%s%s_diff.xml' % (prefix, name), 'w') as out_file:
+                    out_file.write(ElementTree.tostring(tree).decode('ascii'))
 
-    get_config_tree.main(test_clarity, test_file)
-    get_config_tree.main(prod_clarity, prod_file)
+    with open('%s/%s_drift.json' % (DIRECTORY, date), 'w') as out_file:
+        json.dump({'instances': dict(instances), 'drift': drift, 'differences': differences}, out_file, indent=2)
 
-    config_diff.main(test_file, prod_file, test_file_diff, prod_file_diff)
+    print_matrix(names, drift)
@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+"""
+Keeps the load a client puts on the Clarity server, which the whole lab shares, in check.
+
+A Governor limits the number of requests a client has waiting for a response at once, and adapts the limit to how well
+the server is coping, like TCP congestion control (additive increase, multiplicative decrease):
+    * every request answered without trouble raises the limit by increase / limit, so by about increase for every
+      limit requests, up to max_limit,
+    * a 429 or 5xx response, a connection error, or a GET that is much slower than usual (its smoothed time to the
+      response more than latency_tolerance times the fastest it has been for that endpoint) cuts the limit by the
+      decrease factor, down to min_limit. Requests already in flight when the limit is cut cannot cut it again, so a
+      burst of errors only counts once.
+Batch requests vary too much in size for their latency to mean anything, so only errors cut the limit for them.
+
+A request holds its place from being sent until its response headers arrive (transport.PooledOpener), so scripts
+reading long responses at their own pace never hold up the others. A request that is cancelled (as AsyncClarity's can
+be) gives its place back with abandon, which does not change the limit.
+
+Governor.call retries idempotent requests (GET, PUT and DELETE, and batch retrieves and updates, which set whole
+objects) that fail with a 429, 500, 502, 503 or 504 response or a connection error, up to max_retries times. Before
+each retry it waits a random time of up to base_delay * 2 ** attempt seconds (at most max_delay), or as long as a
+Retry-After header asks for.
+
+The limit, the number of requests in flight, and counts of the cuts and retries by reason are recorded in metrics.
+"""
+import email.utils
+import http.client
+import logging
+import random
+import threading
+import time
+from urllib.error import HTTPError, URLError
+from urllib.parse import urlsplit
+
+__author__ = 'rf9'
+
+logger = logging.getLogger(__name__)
+
+MAX_LIMIT = 8
+MAX_RETRIES = 2
+BASE_DELAY = 0.5
+MAX_DELAY = 30
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+RETRYABLE_ERRORS = (URLError, ConnectionError, TimeoutError, http.client.HTTPException)
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS')
+IDEMPOTENT_POSTS = ('/batch/retrieve', '/batch/update')
+# Weight of each new latency in the smoothed latency of an endpoint.
+SMOOTHING = 0.2
+# How fast the fastest latency of an endpoint is allowed to creep up, per request, so that a server that has become
+# slower for good is not treated as overloaded forever.
+FLOOR_DRIFT = 0.01
+# Latencies this close to the fastest are never treated as overload, however many times slower they are.
+MIN_LATENCY_INCREASE = 0.05
+
+
+def is_idempotent(method, url):
+    return method in IDEMPOTENT_METHODS or (method == 'POST' and urlsplit(url).path.endswith(IDEMPOTENT_POSTS))
+
+
+def retry_after(err):
+    # The number of seconds a Retry-After header on an HTTPError asks for, or None.
+    value = err.headers.get('Retry-After') if isinstance(err, HTTPError) and err.headers is not None else None
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class Governor:
+    def __init__(self, max_limit=MAX_LIMIT, min_limit=1, initial_limit=None, increase=1.0, decrease=0.5,
+                 latency_tolerance=2.0, max_retries=MAX_RETRIES, base_delay=BASE_DELAY, max_delay=MAX_DELAY,
+                 metrics=None, seed=None):
+        self.max_limit = max_limit
+        self.min_limit = min(min_limit, max_limit)
+        self.limit = float(initial_limit or max_limit)
+        self.increase = increase
+        self.decrease = decrease
+        self.latency_tolerance = latency_tolerance
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.metrics = metrics
+
+        self.in_flight = 0
+        self._condition = threading.Condition()
+        self._random = random.Random(seed)
+        # Every request is numbered as it starts; the limit was last cut when the last one started was _cut_at.
+        self._started = 0
+        self._cut_at = 0
+        # Endpoint to its smoothed and fastest latency.
+        self._latencies = {}
+
+    @property
+    def current_limit(self):
+        return max(self.min_limit, int(self.limit))
+
+    def acquire(self):
+        # Wait for a place for a request, returning its number to give to release.
+        with self._condition:
+            while self.in_flight >= self.current_limit:
+                self._condition.wait()
+            return self._start()
+
+    def try_acquire(self):
+        # Like acquire, but return None instead of waiting when there is no place.
+        with self._condition:
+            if self.in_flight >= self.current_limit:
+                return None
+            return self._start()
+
+    def _start(self):
+        self.in_flight += 1
+        self._started += 1
+        self._record()
+        return self._started
+
+    def release(self, number, endpoint_name, status, seconds, batch=False):
+        # Give back the place of request number, which got status (or 'error' if there was no response) after
+        # seconds, and adapt the limit.
+        with self._condition:
+            self.in_flight -= 1
+
+            reason = self._overload(endpoint_name, status, seconds, batch)
+            if reason is None:
+                self.limit = min(self.max_limit, self.limit + self.increase / self.limit)
+            elif number > self._cut_at and self.limit > self.min_limit:
+                self.limit = max(self.min_limit, self.limit * self.decrease)
+                self._cut_at = self._started
+                logger.warning('Cut the limit to %d requests at once after %s', self.current_limit,
+                               'slow responses' if reason == 'latency' else 'error %s' % reason)
+                if self.metrics is not None:
+                    self.metrics.record_throttle(reason)
+
+            self._record()
+            self._condition.notify_all()
+
+    def abandon(self, number):
+        # Give back the place of request number without adapting the limit, as it was given up before it finished.
+        with self._condition:
+            self.in_flight -= 1
+            self._record()
+            self._condition.notify_all()
+
+    def _overload(self, endpoint_name, status, seconds, batch):
+        # Why the response shows the server is overloaded ('error', the status or 'latency'), or None if it does not.
+        if status == 'error':
+            return 'error'
+        if status in RETRY_STATUSES:
+            return str(status)
+        if batch:
+            return None
+
+        smoothed, fastest = self._latencies.get(endpoint_name, (seconds, seconds))
+        smoothed += SMOOTHING * (seconds - smoothed)
+        fastest = min(smoothed, fastest * (1 + FLOOR_DRIFT))
+        self._latencies[endpoint_name] = (smoothed, fastest)
+
+        if smoothed > self.latency_tolerance * fastest and smoothed - fastest > MIN_LATENCY_INCREASE:
+            return 'latency'
+        return None
+
+    def _record(self):
+        if self.metrics is not None:
+            self.metrics.record_concurrency(self.current_limit, self.in_flight)
+
+    def retry_delay(self, err, attempt, idempotent=True):
+        # How long to wait before trying again after err on attempt (counting from 0), or None to give up.
+        if not idempotent or attempt >= self.max_retries:
+            return None
+        if isinstance(err, HTTPError):
+            if err.code not in RETRY_STATUSES:
+                return None
+            reason = str(err.code)
+        elif isinstance(err, RETRYABLE_ERRORS):
+            reason = 'error'
+        else:
+            return None
+
+        delay = self._random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        asked_for = retry_after(err)
+        if asked_for is not None:
+            delay = min(self.max_delay, max(delay, asked_for))
+
+        if self.metrics is not None:
+            self.metrics.record_retry(reason)
+        return delay
+
+    def call(self, function, description='request', idempotent=True):
+        # Call function (which makes a request and reads its response), retrying it when it fails as above.
+        attempt = 0
+        while True:
+            try:
+                return function()
+            except RETRYABLE_ERRORS as err:
+                delay = self.retry_delay(err, attempt, idempotent)
+                if delay is None:
+                    raise
+                logger.warning('Retrying %s in %.1fs after error: %s', description, delay, err)
+                time.sleep(delay)
+                attempt += 1
@@ -29,6 +29,11 @@ if __name__ == "__main__":
 
         workflows = clarity.get_object(clarity.root + 'configuration/workflows/').get('workflow')
 
+        # Download the steps and process types of every active workflow up front, a level at a time.
+        active_workflows = [workflow.xml_list[0] for workflow in workflows if workflow.get_first('status') == 'ACTIVE']
+        clarity.prefetch(active_workflows, 'protocols/protocol/steps/step/epp-triggers')
+        clarity.prefetch(active_workflows, 'protocols/protocol/steps/step/process-type')
+
         for workflow in workflows:
             if workflow.get_first('status') == 'ACTIVE':
                 for protocol in workflow.get('protocols').get('protocol'):
@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+"""
+Counters and histograms of the requests a Clarity client makes, for seeing where a job's time goes.
+
+Every Clarity has a Metrics (clarity.metrics), which records:
+    * requests, by method, endpoint, object type and status, with a histogram of their latency (from sending the
+      request to reading the whole response) and the bytes sent and received (as sent over the wire),
+    * the number of objects in each batch retrieve or update,
+    * cache lookups, by cache (memory or disk), object type and result (hit, miss, stale or revalidated),
+    * the limit on requests in flight at once and the number in flight (see governor), and how many times the limit
+      was cut and requests were retried, by reason (the status, 'error' or 'latency').
+
+Endpoints are the path after the root with the ids replaced by {id}, and the names of any query parameters, e.g.
+artifacts/{id}, containers/batch/retrieve or artifacts?process-type&samplelimsid.
+
+metrics.snapshot() returns everything recorded as a dictionary, and metrics.dump(path) writes it as json, or as
+Prometheus text if path ends in .prom. When the CLARITY_METRICS environment variable is set, every client shares one
+Metrics, which is written to the file it names when the script exits.
+"""
+import bisect
+import json
+import re
+import sys
+import threading
+from urllib.parse import parse_qsl, urlsplit
+
+__author__ = 'rf9'
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+BATCH_SIZE_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000)
+ID_PATTERN = re.compile(r'\d')
+
+
+def endpoint(root, url):
+    # The endpoint (see above) and object type of a url.
+    if url.startswith(root):
+        url = url[len(root):]
+    parts = urlsplit(url)
+    segments = [('{id}' if ID_PATTERN.search(segment) else segment) for segment in parts.path.strip('/').split('/')]
+    name = '/'.join(segments)
+    if parts.query:
+        name += '?' + '&'.join(sorted({key for key, value in parse_qsl(parts.query, keep_blank_values=True)}))
+    return name, segments[0] or None
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        # One more than there are buckets, for the values above the last one.
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        # (upper bound, number of values at or below it) for every bucket, ending with ('+Inf', count).
+        total = 0
+        result = []
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'buckets': {str(bound): count for bound, count in self.cumulative()},
+        }
+
+
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._requests = {}
+        self._batches = {}
+        self._cache = {}
+        self._concurrency = {}
+        self._throttles = {}
+        self._retries = {}
+
+    def record_request(self, method, endpoint_name, object_type, status, seconds, bytes_sent=0, bytes_received=0):
+        # status is the HTTP status code, or 'error' if there was no response.
+        with self._lock:
+            key = (method, endpoint_name, object_type)
+            stats = self._requests.get(key)
+            if stats is None:
+                stats = self._requests[key] = {
+                    'statuses': {},
+                    'latency': Histogram(LATENCY_BUCKETS),
+                    'bytes_sent': 0,
+                    'bytes_received': 0,
+                }
+            stats['statuses'][str(status)] = stats['statuses'].get(str(status), 0) + 1
+            stats['latency'].observe(seconds)
+            stats['bytes_sent'] += bytes_sent
+            stats['bytes_received'] += bytes_received
+
+    def record_batch(self, operation, object_type, size):
+        with self._lock:
+            key = (operation, object_type)
+            if key not in self._batches:
+                self._batches[key] = Histogram(BATCH_SIZE_BUCKETS)
+            self._batches[key].observe(size)
+
+    def record_cache(self, cache, object_type, result, count=1):
+        with self._lock:
+            key = (cache, object_type, result)
+            self._cache[key] = self._cache.get(key, 0) + count
+
+    def record_concurrency(self, limit, in_flight):
+        with self._lock:
+            self._concurrency['limit'] = limit
+            self._concurrency['in_flight'] = in_flight
+            self._concurrency['max_in_flight'] = max(in_flight, self._concurrency.get('max_in_flight', 0))
+
+    def record_throttle(self, reason):
+        with self._lock:
+            self._throttles[reason] = self._throttles.get(reason, 0) + 1
+
+    def record_retry(self, reason):
+        with self._lock:
+            self._retries[reason] = self._retries.get(reason, 0) + 1
+
+    def clear(self):
+        # The current limit and requests in flight are kept, as they are still current.
+        with self._lock:
+            self._requests.clear()
+            self._batches.clear()
+            self._cache.clear()
+            self._throttles.clear()
+            self._retries.clear()
+            self._concurrency.pop('max_in_flight', None)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'requests': [{
+                    'method': method,
+                    'endpoint': endpoint_name,
+                    'object_type': object_type,
+                    'count': stats['latency'].count,
+                    'statuses': dict(stats['statuses']),
+                    'seconds': stats['latency'].to_dict(),
+                    'bytes_sent': stats['bytes_sent'],
+                    'bytes_received': stats['bytes_received'],
+                } for (method, endpoint_name, object_type), stats in sorted(self._requests.items(), key=_sort_key)],
+                'batches': [{
+                    'operation': operation,
+                    'object_type': object_type,
+                    'sizes': histogram.to_dict(),
+                } for (operation, object_type), histogram in sorted(self._batches.items(), key=_sort_key)],
+                'cache': [{
+                    'cache': cache,
+                    'object_type': object_type,
+                    'result': result,
+                    'count': count,
+                } for (cache, object_type, result), count in sorted(self._cache.items(), key=_sort_key)],
+                'concurrency': dict(self._concurrency),
+                'throttles': [{'reason': reason, 'count': count} for reason, count in sorted(self._throttles.items())],
+                'retries': [{'reason': reason, 'count': count} for reason, count in sorted(self._retries.items())],
+            }
+
+    def to_json(self):
+        return json.dumps(self.snapshot(), indent=2)
+
+    def to_prometheus(self):
+        lines = []
+
+        def metric(name, metric_type, description):
+            lines.append('# HELP %s %s' % (name, description))
+            lines.append('# TYPE %s %s' % (name, metric_type))
+
+        def histogram(name, labels, values):
+            for bound, count in values['buckets'].items():
+                lines.append('%s_bucket%s %d' % (name, _labels(labels + [('le', bound)]), count))
+            lines.append('%s_sum%s %s' % (name, _labels(labels), _number(values['sum'])))
+            lines.append('%s_count%s %d' % (name, _labels(labels), values['count']))
+
+        snapshot = self.snapshot()
+
+        metric('clarity_requests_total', 'counter', 'Requests sent to the Clarity server.')
+        for stats in snapshot['requests']:
+            labels = [('method', stats['method']), ('endpoint', stats['endpoint']),
+                      ('object_type', stats['object_type'])]
+            for status, count in sorted(stats['statuses'].items()):
+                lines.append('clarity_requests_total%s %d' % (_labels(labels + [('status', status)]), count))
+
+        metric('clarity_request_duration_seconds', 'histogram', 'Time from sending a request to reading its response.')
+        for stats in snapshot['requests']:
+            labels = [('method', stats['method']), ('endpoint', stats['endpoint']),
+                      ('object_type', stats['object_type'])]
+            histogram('clarity_request_duration_seconds', labels, stats['seconds'])
+
+        for direction in ('sent', 'received'):
+            metric('clarity_bytes_%s_total' % direction, 'counter', 'Bytes %s over the wire.' % direction)
+            for stats in snapshot['requests']:
+                labels = [('method', stats['method']), ('endpoint', stats['endpoint']),
+                          ('object_type', stats['object_type'])]
+                lines.append('clarity_bytes_%s_total%s %d' % (direction, _labels(labels), stats['bytes_' + direction]))
+
+        metric('clarity_batch_size', 'histogram', 'Objects in each batch retrieve or update.')
+        for batch in snapshot['batches']:
+            histogram('clarity_batch_size', [('operation', batch['operation']), ('object_type', batch['object_type'])],
+                      batch['sizes'])
+
+        metric('clarity_cache_lookups_total', 'counter', 'Cache lookups by result.')
+        for lookup in snapshot['cache']:
+            labels = [('cache', lookup['cache']), ('object_type', lookup['object_type']), ('result', lookup['result'])]
+            lines.append('clarity_cache_lookups_total%s %d' % (_labels(labels), lookup['count']))
+
+        gauges = (('limit', 'clarity_concurrency_limit', 'Requests allowed in flight at once.'),
+                  ('in_flight', 'clarity_requests_in_flight', 'Requests waiting for a response.'),
+                  ('max_in_flight', 'clarity_requests_in_flight_max', 'Most requests waiting for a response at once.'))
+        for key, name, description in gauges:
+            if key in snapshot['concurrency']:
+                metric(name, 'gauge', description)
+                lines.append('%s %d' % (name, snapshot['concurrency'][key]))
+
+        metric('clarity_concurrency_cuts_total', 'counter', 'Times the limit on requests in flight was cut.')
+        for throttle in snapshot['throttles']:
+            lines.append('clarity_concurrency_cuts_total%s %d' % (_labels([('reason', throttle['reason'])]),
+                                                                  throttle['count']))
+
+        metric('clarity_retries_total', 'counter', 'Requests retried after an error.')
+        for retry in snapshot['retries']:
+            lines.append('clarity_retries_total%s %d' % (_labels([('reason', retry['reason'])]), retry['count']))
+
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, path=None):
+        # Write the metrics to path (json, or Prometheus text if it ends in .prom), or as json to stderr.
+        if path is None:
+            sys.stderr.write(self.to_json() + '\n')
+            return
+
+        text = self.to_prometheus() if path.endswith('.prom') else self.to_json() + '\n'
+        with open(path, 'w') as out_file:
+            out_file.write(text)
+
+
+def _sort_key(item):
+    return tuple('' if part is None else str(part) for part in item[0])
+
+
+def _number(value):
+    return repr(float(value))
+
+
+def _labels(labels):
+    def escape(value):
+        return str(value if value is not None else '').replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    return '{%s}' % ','.join('%s="%s"' % (name, escape(value)) for name, value in labels)
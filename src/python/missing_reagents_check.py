@@ -1,54 +1,57 @@
 #!/usr/bin/env python3
+"""
+List the processes with outputs of the Library PCR set up process type that have no reagent labels.
 
-import getpass
-from urllib import request
-from xml.etree import ElementTree
-import sys
-
-__author__ = 'rf9'
+usage: python missing_reagents_check.py [--restart] [--start-index=<n>] <root_uri> <journal_file>
 
+The artifacts are checked page by page, from start-index (3500 by default) back to the first page. The parent process
+of every artifact without a reagent label is printed, and a '.' for every other artifact. Progress is kept in the
+journal file (see crawl), so when the script is stopped and run again it carries on where it stopped, without checking
+any artifact twice. Once every page has been checked, --restart starts again from the beginning.
+"""
 
-def setup_urllib():
-    password_mgr = request.HTTPPasswordMgrWithDefaultRealm()
-    password_mgr.add_password(None, root_url, USER, PASS)
-    handler = request.HTTPBasicAuthHandler(password_mgr)
-    opener = request.build_opener(handler)
-    opener.open(root_url)
-    request.install_opener(opener)
+import sys
 
+from clarity import Clarity
+from crawl import Crawl
 
-def get_xml(uri):
-    xml = request.urlopen(uri)
-    return ElementTree.parse(xml).getroot()
+__author__ = 'rf9'
 
+PROCESS_TYPE = "Library PCR set up"
+START_INDEX = 3500
 
 if __name__ == "__main__":
-    if len(sys.argv) == 2:
-        root_url = sys.argv[1]
+    args = sys.argv[1:]
+    restart = '--restart' in args
+    if restart:
+        args.remove('--restart')
+    start_indexes = [arg.split('=', 1)[1] for arg in args if arg.startswith('--start-index=')]
+    args = [arg for arg in args if not arg.startswith('--start-index=')]
+
+    if len(args) == 2:
+        root_url = args[0]
+        journal_path = args[1]
     else:
-        sys.stderr.write("usage: python missing_reagents_check.py <root_uri>\n")
+        sys.stderr.write("usage: python missing_reagents_check.py [--restart] [--start-index=<n>] <root_uri> "
+                         "<journal_file>\n")
         sys.exit(1)
 
-    if root_url[-1] != '/':
-        root_url += "/"
-
-    USER = getpass.getuser()
-    USER = input("Username (leave blank for '" + USER + "'): ") or USER
-    PASS = getpass.getpass('Password: ')
-
-    setup_urllib()
+    clarity = Clarity(root_url)
 
-    process_type = "Library PCR set up".replace(' ', '%20')
-    uri = root_url + 'artifacts?process-type=' + process_type + '&start-index=3500'
+    process_type = PROCESS_TYPE.replace(' ', '%20')
+    start_index = int(start_indexes[-1]) if start_indexes else START_INDEX
+    uri = clarity.root + 'artifacts?process-type=' + process_type + '&start-index=%d' % start_index
 
-    while 1:
-        xml = get_xml(uri)
+    crawl = Crawl(clarity, journal_path, uri, follow='previous-page')
+    if restart:
+        crawl.restart()
 
-        for artifact in xml.findall('artifact'):
-            artifact_xml = get_xml(artifact.get('uri'))
-            if not artifact_xml.findall('reagent-label'):
-                print(artifact_xml.find('parent-process').get('uri'))
-            else:
-                print('.')
+    for artifact_xml in crawl.iter(resolve=True):
+        if not artifact_xml.findall('reagent-label'):
+            print(artifact_xml.find('parent-process').get('uri'))
+        else:
+            print('.')
 
-        uri = xml.find('previous-page').get('uri')
+    page, pages, finished = crawl.state()
+    sys.stderr.write('Checked %d artifacts on %d pages\n' % (len(crawl), pages))
+    crawl.close()
@@ -17,14 +17,7 @@ if __name__ == '__main__':
     with open(in_file) as f:
         uuids = [l.strip() for l in f]
 
-    batch_size = 100
-
-    sample_uris = []
-
-    for i in range(0, len(uuids), batch_size):
-        search_xml = clarity.get_xml(
-            clarity.root + 'samples?' + '&'.join(['name=' + uuid.strip() for uuid in uuids[i:i + batch_size]]))
-        sample_uris += [sample.get('uri') for sample in search_xml.findall('sample')]
+    sample_uris = [sample.get('uri') for sample in clarity.search('samples', 'name', uuids)]
 
     samples = clarity.get_xml(sample_uris)
 
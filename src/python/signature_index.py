@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+"""
+A local index of container signature (the WTSI Container Signature UDF) to container, kept in an SQLite file.
+
+    index = SignatureIndex('signatures.sqlite')
+    index.refresh(clarity)
+    container_uri = index.lookup('ABC+123/')
+
+refresh pages through the list of containers from where the last refresh got to, downloading max_workers pages at once
+and batch retrieving the containers on them, and records every container's signature. The list is in the order the
+containers were created, so only containers created since the last refresh are downloaded (plus the last
+REFRESH_OVERLAP again, in case they were given a signature after they were indexed). refresh(clarity, full=True) starts
+again from the beginning.
+
+Lookups are answered from the index without asking the server. A signature given to an older container after it was
+indexed is not found by a refresh, only by a full one; search finds such signatures on the server and adds them.
+"""
+import sqlite3
+import threading
+import time
+
+from cache import select_in, udf_map
+
+__author__ = 'rf9'
+
+SIGNATURE = "WTSI Container Signature"
+REFRESH_OVERLAP = 500
+
+
+class SignatureIndex:
+    def __init__(self, path):
+        self.path = path
+
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._connection:
+            self._connection.execute('CREATE TABLE IF NOT EXISTS container ('
+                                     'uri TEXT PRIMARY KEY, '
+                                     'name TEXT, '
+                                     'signature TEXT, '
+                                     'indexed REAL NOT NULL)')
+            self._connection.execute('CREATE INDEX IF NOT EXISTS container_signature ON container (signature)')
+            self._connection.execute('CREATE TABLE IF NOT EXISTS crawl (key TEXT PRIMARY KEY, value INTEGER)')
+
+    def __len__(self):
+        with self._lock:
+            return self._connection.execute('SELECT COUNT(*) FROM container').fetchone()[0]
+
+    def next_start(self):
+        # The start-index of the first container in the list that has not been indexed.
+        with self._lock:
+            row = self._connection.execute("SELECT value FROM crawl WHERE key = 'next_start'").fetchone()
+        return row[0] if row else 0
+
+    def _set_next_start(self, start):
+        with self._lock, self._connection:
+            self._connection.execute("INSERT OR REPLACE INTO crawl VALUES ('next_start', ?)", (start,))
+
+    def add(self, containers):
+        # Index (or re-index) the container elements.
+        now = time.time()
+        rows = []
+        for container in containers:
+            fields = udf_map(container).get(SIGNATURE)
+            name = container.find('name')
+            rows.append((container.get('uri'), name.text if name is not None else None,
+                         fields[0].text if fields else None, now))
+
+        with self._lock, self._connection:
+            self._connection.executemany('INSERT OR REPLACE INTO container VALUES (?, ?, ?, ?)', rows)
+
+    def lookup(self, signature):
+        # The uri of the container with the signature, or None if it is not in the index.
+        return self.lookup_many([signature]).get(signature)
+
+    def lookup_many(self, signatures):
+        # A dictionary of signature to container uri, for the signatures that are in the index.
+        with self._lock:
+            return dict(select_in(self._connection, 'SELECT signature, uri FROM container WHERE signature IN (%s)',
+                                  set(signatures)))
+
+    def search(self, clarity, signatures):
+        # Search the server for the containers with the signatures (e.g. the ones lookup_many did not find), add them
+        # to the index and return them.
+        links = clarity.search('containers', 'udf.' + SIGNATURE, list(signatures))
+        containers = clarity.get_xml([link.get('uri') for link in links])
+        self.add(containers)
+        return containers
+
+    def signatures(self):
+        # Every (signature, container uri) in the index, in signature order.
+        with self._lock:
+            return self._connection.execute('SELECT signature, uri FROM container WHERE signature IS NOT NULL '
+                                            'ORDER BY signature').fetchall()
+
+    def refresh(self, clarity, full=False):
+        # Index the containers created since the last refresh. Returns the number of containers downloaded.
+        start = 0 if full else max(0, self.next_start() - REFRESH_OVERLAP)
+        page_size = None
+        downloaded = 0
+
+        while True:
+            # The size of the pages is not known until the first one has been seen.
+            starts = [start] if page_size is None else [start + i * page_size for i in range(clarity.max_workers)]
+            pages = clarity.get_pages(clarity.root + 'containers?start-index=%d' % page_start for page_start in starts)
+
+            links = []
+            finished = False
+            for page_start, page in zip(starts, pages):
+                page_links = page.findall('container')
+                links += page_links
+                if page_size is None:
+                    page_size = len(page_links)
+
+                start = page_start + len(page_links)
+                if not page_links or len(page_links) < page_size or page.find('next-page') is None:
+                    finished = True
+                    break
+
+            containers = clarity.get_xml([link.get('uri') for link in links])
+            self.add(containers)
+            downloaded += len(containers)
+            self._set_next_start(start)
+
+            if finished:
+                return downloaded
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
@@ -1,50 +1,60 @@
 #!/usr/bin/env python3
-import getpass
-import urllib.request as request
-from xml.etree import ElementTree
+"""
+Look up containers by signature (the WTSI Container Signature UDF).
 
-import sys
-
-__author__ = 'rf9'
+usage: python signature_lookup.py <root_uri> <index_file> [--full] [<signature> ...]
 
-SIGNATURE = "WTSI Container Signature"
-FIELD = "{http://genologics.com/ri/userdefined}field"
-
-
-def setup_urllib():
-    password_mgr = request.HTTPPasswordMgrWithDefaultRealm()
-    password_mgr.add_password(None, root_url, user, password)
-    handler = request.HTTPBasicAuthHandler(password_mgr)
-    opener = request.build_opener(handler)
-    opener.open(root_url)
-    request.install_opener(opener)
+The local signature index in index_file (see signature_index) is brought up to date first, which only downloads the
+containers created since it was last brought up to date (or every container with --full, or when index_file is new).
+Then the container for each signature given is printed, or every signature in the index if none are given. Signatures
+that are not in the index are searched for on the server, as an older container may have been given a signature since
+it was indexed. Any that are found are added to the index, and a warning suggests --full.
+"""
 
+import sys
 
-def get_xml(uri):
-    with request.urlopen(uri) as data:
-        return ElementTree.parse(data).getroot()
+from clarity import Clarity
+from cache import udf_map
+from signature_index import SIGNATURE, SignatureIndex
 
+__author__ = 'rf9'
 
 if __name__ == '__main__':
-    if len(sys.argv) == 2:
-        root_url = sys.argv[1]
+    args = sys.argv[1:]
+    full = '--full' in args
+    if full:
+        args.remove('--full')
+
+    if len(args) >= 2:
+        root_url = args[0]
+        index_path = args[1]
+        signatures = args[2:]
     else:
-        sys.stderr.write("usage: python signature_lookup.py <root_uri>\n")
+        sys.stderr.write("usage: python signature_lookup.py <root_uri> <index_file> [--full] [<signature> ...]\n")
         sys.exit(1)
 
-    if root_url[-1] != '/':
-        root_url += "/"
-
-    user = getpass.getuser()
-    user = input("Username (leave blank for '" + user + "'): ") or user
-    password = getpass.getpass('Password: ')
-
-    setup_urllib()
-
-    for index in ['4000']:
-        for container in get_xml(request.urljoin(root_url, "containers?start-index=" + index)).findall("container"):
-            container = get_xml(container.get("uri"))
+    clarity = Clarity(root_url)
+    index = SignatureIndex(index_path)
+
+    downloaded = index.refresh(clarity, full=full)
+    sys.stderr.write('Indexed %d containers (%d in the index)\n' % (downloaded, len(index)))
+
+    if signatures:
+        found = index.lookup_many(signatures)
+        missing = [signature for signature in signatures if signature not in found]
+        if missing:
+            for container in index.search(clarity, missing):
+                for field in udf_map(container).get(SIGNATURE, ()):
+                    found[field.text] = container.get('uri')
+            searched = [signature for signature in missing if signature in found]
+            if searched:
+                sys.stderr.write('%d signatures were not in the index but were found on the server; run with --full to '
+                                 'index the older containers again\n' % len(searched))
+
+        for signature in signatures:
+            print('%s\t%s' % (signature, found.get(signature, '')))
+    else:
+        for signature, uri in index.signatures():
+            print(signature)
 
-            for field in container.findall(FIELD):
-                if field.get("name") == SIGNATURE:
-                    print(field.text)
+    index.close()
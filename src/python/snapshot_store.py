@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+"""
+A content-addressed store of configuration snapshots (as made by get_config_tree).
+
+Every element of a snapshot is stored once, under its content hash (see canonical_xml), as a small json record of its
+tag, attributes, text and the hashes of its children. A subtree that is in many snapshots (or in many places in one
+snapshot) is only stored once. Children are always written before their parents, so a save that is interrupted never
+leaves a record whose children are missing, and the next save writes whatever it did not get to.
+
+Each snapshot also records a manifest of the content hash of every configuration object it was built from, by uri, so
+the objects that changed between two snapshots can be listed without comparing the trees. Manifests are stored under
+their own hash too, and a snapshot with the same tree and manifest as the latest one is not written at all, so an
+unchanged snapshot costs nothing.
+
+Snapshot names must sort in the order the snapshots were taken (check_same uses the date and time).
+
+Layout of the store directory:
+    objects/<first 2 hex digits>/<rest of hash>     an element record
+    manifests/<first 2 hex digits>/<rest of hash>   a manifest
+    snapshots/<name>.json                           the root hash, creation time and manifest hash of a snapshot
+    latest                                          the name of the latest snapshot
+"""
+import hashlib
+import json
+import os
+import time
+from xml.etree import ElementTree
+
+from canonical_xml import TreeHasher
+
+__author__ = 'rf9'
+
+
+def _write(path, data):
+    # Write the whole file or nothing.
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.tmp', 'w') as out_file:
+        out_file.write(data)
+    os.replace(path + '.tmp', path)
+
+
+class SnapshotStore:
+    def __init__(self, directory):
+        self.directory = directory
+        self._objects = os.path.join(directory, 'objects')
+        self._manifests = os.path.join(directory, 'manifests')
+        self._snapshots = os.path.join(directory, 'snapshots')
+        self._latest = os.path.join(directory, 'latest')
+        os.makedirs(self._objects, exist_ok=True)
+        os.makedirs(self._manifests, exist_ok=True)
+        os.makedirs(self._snapshots, exist_ok=True)
+
+    def _object_path(self, digest):
+        return os.path.join(self._objects, digest[:2], digest[2:])
+
+    def _manifest_path(self, digest):
+        return os.path.join(self._manifests, digest[:2], digest[2:])
+
+    def _snapshot_path(self, name):
+        return os.path.join(self._snapshots, name + '.json')
+
+    def save(self, name, tree, manifest=None):
+        # Store the tree as the snapshot called name, writing only the elements the store does not already have.
+        # If the tree and manifest are the same as the latest snapshot's, no snapshot is written.
+        # Returns the hash of the tree and the number of new elements written.
+        hasher = TreeHasher()
+        seen = set()
+        new_objects = 0
+
+        # Every element is checked, not just the roots of subtrees, so a store with missing records is repaired.
+        stack = [(tree, False)]
+        while stack:
+            element, children_done = stack.pop()
+            if not children_done:
+                digest = hasher.hexdigest(element)
+                if digest in seen:
+                    continue
+                seen.add(digest)
+                stack.append((element, True))
+                stack.extend((child, False) for child in element)
+                continue
+
+            path = self._object_path(hasher.hexdigest(element))
+            if os.path.exists(path):
+                continue
+
+            record = {
+                'tag': element.tag,
+                'attrib': dict(element.items()),
+                'text': element.text,
+                'children': [hasher.hexdigest(child) for child in element],
+            }
+            _write(path, json.dumps(record))
+            new_objects += 1
+
+        root = hasher.hexdigest(tree)
+
+        manifest_data = json.dumps(manifest or {}, sort_keys=True)
+        manifest_digest = hashlib.sha1(manifest_data.encode('utf-8')).hexdigest()
+        if not os.path.exists(self._manifest_path(manifest_digest)):
+            _write(self._manifest_path(manifest_digest), manifest_data)
+
+        latest = self.latest()
+        if latest is not None:
+            info = self.info(latest)
+            if info['root'] == root and info['manifest'] == manifest_digest:
+                return root, new_objects
+
+        _write(self._snapshot_path(name),
+               json.dumps({'root': root, 'created': time.time(), 'manifest': manifest_digest}, indent=1,
+                          sort_keys=True))
+        _write(self._latest, name)
+
+        return root, new_objects
+
+    def names(self):
+        # The names of all the snapshots, oldest first.
+        return sorted(filename[:-len('.json')] for filename in os.listdir(self._snapshots)
+                      if filename.endswith('.json'))
+
+    def latest(self):
+        if os.path.exists(self._latest):
+            with open(self._latest) as in_file:
+                return in_file.read()
+
+        names = self.names()
+        return names[-1] if names else None
+
+    def info(self, name):
+        with open(self._snapshot_path(name)) as in_file:
+            return json.load(in_file)
+
+    def manifest(self, name):
+        manifest = self.info(name)['manifest']
+        if isinstance(manifest, dict):
+            # Snapshots written before manifests were stored by hash have them inline.
+            return manifest
+
+        with open(self._manifest_path(manifest)) as in_file:
+            return json.load(in_file)
+
+    def load(self, name):
+        return self.load_object(self.info(name)['root'])
+
+    def load_object(self, digest):
+        records = {}
+
+        def build(element_digest):
+            if element_digest not in records:
+                with open(self._object_path(element_digest)) as in_file:
+                    records[element_digest] = json.load(in_file)
+            record = records[element_digest]
+
+            element = ElementTree.Element(record['tag'], record['attrib'])
+            element.text = record['text']
+            element.extend(build(child) for child in record['children'])
+            return element
+
+        return build(digest)
+
+    def changed_objects(self, name1, name2):
+        # The uris of the configuration objects that were added, removed or changed between two snapshots.
+        manifest1 = self.manifest(name1)
+        manifest2 = self.manifest(name2)
+        return {
+            'added': sorted(set(manifest2) - set(manifest1)),
+            'removed': sorted(set(manifest1) - set(manifest2)),
+            'changed': sorted(uri for uri in set(manifest1) & set(manifest2) if manifest1[uri] != manifest2[uri]),
+        }
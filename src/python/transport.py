@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+"""
+A replacement for the urllib opener used by clarity.Clarity that keeps connections to the server open between requests.
+
+PooledOpener has the same open(url_or_request) method as a urllib OpenerDirector, so the rest of Clarity is unchanged,
+but it:
+    * reuses idle keep-alive connections (up to pool_size per host, safe to share between threads),
+    * sends the basic auth header with every request instead of waiting to be challenged for it,
+    * asks for gzip or deflate compressed responses and decompresses them as they are read.
+
+Like the urllib opener, it goes through the proxies given by the http_proxy, https_proxy and no_proxy environment
+variables (https through a CONNECT tunnel), and follows redirects the way urllib.request.HTTPRedirectHandler does.
+Other responses with an error status raise urllib.error.HTTPError, and connection failures raise urllib.error.URLError,
+as they would from urllib.
+
+Given a metrics.Metrics, every request is recorded in it when its response is closed (or when it fails), with its
+latency and the bytes sent and received over the wire.
+
+Given a governor.Governor, every request waits for a place from it before it is sent, and gives the place back, with
+the status and how long the response took to start, as soon as the response headers have arrived.
+"""
+import base64
+import gzip
+import http.client
+import io
+import queue
+import threading
+import time
+import zlib
+from urllib.error import HTTPError, URLError
+from urllib.parse import urljoin, urlsplit
+from urllib.request import HTTPRedirectHandler, Request, getproxies, proxy_bypass
+
+from metrics import endpoint
+
+__author__ = 'rf9'
+
+POOL_SIZE = 8
+REDIRECT_CODES = (301, 302, 303, 307, 308)
+ACCEPT_ENCODING = 'gzip, deflate'
+# Errors that mean an idle connection was closed by the server before it could be reused.
+STALE_CONNECTION_ERRORS = (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError)
+
+
+def basic_authorization(user, password):
+    credentials = ('%s:%s' % (user, password)).encode('utf-8')
+    return 'Basic ' + base64.b64encode(credentials).decode('ascii')
+
+
+def decompress(data, encoding):
+    # Decompress a whole body sent with the Content-Encoding encoding (or None).
+    encoding = (encoding or '').lower()
+    if encoding == 'gzip':
+        return gzip.decompress(data)
+    if encoding == 'deflate':
+        return _DeflateReader(io.BytesIO(data)).read()
+    return data
+
+
+class Response:
+    def __init__(self, opener, key, connection, response, on_close=None):
+        self._opener = opener
+        self._key = key
+        self._connection = connection
+        self._response = response
+        self._on_close = on_close
+
+        self.status = self.code = response.status
+        self.reason = self.msg = response.reason
+        self.headers = response.headers
+
+        # Count the bytes as they come off the wire, before they are decompressed.
+        self._raw = _CountingReader(response)
+        encoding = (response.headers.get('Content-Encoding') or '').lower()
+        if encoding == 'gzip':
+            self._body = gzip.GzipFile(fileobj=self._raw)
+        elif encoding == 'deflate':
+            self._body = _DeflateReader(self._raw)
+        else:
+            self._body = self._raw
+
+    def read(self, size=-1):
+        return self._body.read(-1 if size is None else size)
+
+    def readable(self):
+        return True
+
+    def close(self):
+        if self._connection is None:
+            return
+
+        if self._on_close is not None:
+            self._on_close(self.status, self._raw.bytes_read)
+
+        # A connection can only be reused once the whole of the previous response has been read.
+        if self._response.isclosed() and not self._response.will_close:
+            self._opener._release(self._key, self._connection)
+        else:
+            self._connection.close()
+        self._response.close()
+        self._connection = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class _CountingReader:
+    def __init__(self, raw):
+        self._raw = raw
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        # HTTPResponse reads until the connection closes when given a negative size, so ask for everything instead.
+        data = self._raw.read() if size is None or size < 0 else self._raw.read(size)
+        self.bytes_read += len(data)
+        return data
+
+
+class _DeflateReader:
+    def __init__(self, raw):
+        self._raw = raw
+        # Servers disagree about whether deflate means a zlib stream or a raw deflate stream, so try a zlib stream
+        # first, and start again as a raw one if the zlib header is wrong.
+        self._decompressor = zlib.decompressobj(zlib.MAX_WBITS)
+        self._started = False
+        self._buffer = b''
+
+    def _decompress(self, chunk):
+        if self._started:
+            return self._decompressor.decompress(chunk)
+
+        self._started = True
+        try:
+            return self._decompressor.decompress(chunk)
+        except zlib.error:
+            self._decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+            return self._decompressor.decompress(chunk)
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) < size:
+            chunk = self._raw.read(64 * 1024)
+            if not chunk:
+                self._buffer += self._decompressor.flush()
+                break
+            self._buffer += self._decompress(chunk)
+
+        if size < 0:
+            data, self._buffer = self._buffer, b''
+        else:
+            data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+
+class PooledOpener:
+    def __init__(self, root, user, password, pool_size=POOL_SIZE, timeout=None, metrics=None, governor=None):
+        self.root = root
+        self.metrics = metrics
+        self.governor = governor
+        root_parts = urlsplit(root)
+        self._auth_netloc = (root_parts.scheme, root_parts.netloc)
+        self._authorization = basic_authorization(user, password)
+
+        self.pool_size = pool_size
+        self.timeout = timeout
+
+        self._proxies = getproxies()
+        self._redirect_handler = HTTPRedirectHandler()
+
+        self._lock = threading.Lock()
+        self._pools = {}
+
+    def _pool(self, key):
+        with self._lock:
+            if key not in self._pools:
+                self._pools[key] = queue.LifoQueue()
+            return self._pools[key]
+
+    def _proxy(self, key):
+        # The parts of the url of the proxy to use for a scheme and host, or None to connect directly.
+        scheme, netloc = key
+        proxy = self._proxies.get(scheme)
+        if proxy is None or proxy_bypass(urlsplit('//' + netloc).hostname):
+            return None
+        if '://' not in proxy:
+            proxy = 'http://' + proxy
+        return urlsplit(proxy)
+
+    def _proxy_authorization(self, proxy):
+        return {'Proxy-Authorization': basic_authorization(proxy.username, proxy.password or '')}
+
+    def _acquire(self, key):
+        try:
+            return self._pool(key).get_nowait(), True
+        except queue.Empty:
+            scheme, netloc = key
+            proxy = self._proxy(key)
+            if scheme == 'https':
+                if proxy is None:
+                    return http.client.HTTPSConnection(netloc, timeout=self.timeout), False
+                connection = http.client.HTTPSConnection(proxy.netloc.rpartition('@')[2], timeout=self.timeout)
+                connection.set_tunnel(netloc, headers=self._proxy_authorization(proxy) if proxy.username else None)
+                return connection, False
+
+            address = netloc if proxy is None else proxy.netloc.rpartition('@')[2]
+            return http.client.HTTPConnection(address, timeout=self.timeout), False
+
+    def _release(self, key, connection):
+        pool = self._pool(key)
+        if pool.qsize() < self.pool_size:
+            pool.put(connection)
+        else:
+            connection.close()
+
+    def close(self):
+        with self._lock:
+            pools, self._pools = self._pools, {}
+        for pool in pools.values():
+            while not pool.empty():
+                pool.get_nowait().close()
+
+    def open(self, url, data=None):
+        req = url if isinstance(url, Request) else Request(url, data=data)
+
+        for redirects in range(HTTPRedirectHandler.max_redirections + 1):
+            wrapped = self._open(req)
+            status = wrapped.status
+
+            location = wrapped.headers.get('Location') or wrapped.headers.get('URI')
+            if status in REDIRECT_CODES and location is not None \
+                    and redirects < HTTPRedirectHandler.max_redirections:
+                body = wrapped.read()
+                wrapped.close()
+                # Raises an HTTPError for a redirect urllib would not follow, such as a 307 of a POST.
+                req = self._redirect_handler.redirect_request(req, io.BytesIO(body), status, wrapped.reason,
+                                                              wrapped.headers, urljoin(req.full_url, location))
+                continue
+
+            # Like urllib, anything other than a success (including 304 Not Modified) is raised as an HTTPError.
+            if status >= 300:
+                body = wrapped.read()
+                wrapped.close()
+                raise HTTPError(req.full_url, status, wrapped.reason, wrapped.headers, io.BytesIO(body))
+
+            return wrapped
+
+    def _open(self, req):
+        parts = urlsplit(req.full_url)
+        key = (parts.scheme, parts.netloc)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+
+        headers = dict(req.header_items())
+        headers.setdefault('Accept-Encoding', ACCEPT_ENCODING)
+        if key == self._auth_netloc:
+            headers.setdefault('Authorization', self._authorization)
+
+        proxy = self._proxy(key)
+        if proxy is not None and parts.scheme == 'http':
+            # A plain http proxy is sent the whole url.
+            path = '%s://%s%s' % (parts.scheme, parts.netloc, path)
+            if proxy.username:
+                headers.update(self._proxy_authorization(proxy))
+
+        endpoint_name, object_type = endpoint(self.root, req.full_url)
+        place = self.governor.acquire() if self.governor is not None else None
+
+        start = time.monotonic()
+        bytes_sent = len(req.data or b'')
+
+        def record(status, bytes_received=0):
+            if self.metrics is not None:
+                self.metrics.record_request(req.get_method(), endpoint_name, object_type, status,
+                                            time.monotonic() - start, bytes_sent, bytes_received)
+
+        status = 'error'
+        try:
+            while True:
+                connection, reused = self._acquire(key)
+                try:
+                    connection.request(req.get_method(), path, body=req.data, headers=headers)
+                    response = connection.getresponse()
+                    break
+                except STALE_CONNECTION_ERRORS as err:
+                    connection.close()
+                    # The server closed the idle connection, so try again on a new one.
+                    if not reused:
+                        record('error')
+                        raise URLError(err)
+                except OSError as err:
+                    connection.close()
+                    record('error')
+                    raise URLError(err)
+            status = response.status
+        finally:
+            if place is not None:
+                self.governor.release(place, endpoint_name, status, time.monotonic() - start, req.data is not None)
+
+        return Response(self, key, connection, response, record)
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""
+Bulk updates of the UDFs of many Clarity objects, sent as batch updates.
+
+    updater = UdfUpdater(clarity, 'samples')
+    for sample in samples:
+        updater.update(sample, {'WTSI Library Molarity': '12.5'})
+    updater.flush()
+    updater.report()
+
+The values are saved up, and whenever flush_size objects are waiting (and by flush at the end) the objects are
+downloaded again, bypassing the cache, in one batch retrieve. A batch update replaces the whole object, so the new
+values are set on the current version from the server, not a cached one that could be missing changes made since. Values
+that are already set (as the same text, or as the same number) are skipped, and so are objects with nothing to change.
+The rest are sent through Clarity.batch_post_xml (in concurrent chunks of batch_size).
+
+With dry_run=True nothing is sent, but the changes and the number of batch update requests that would have been made
+are recorded, and report prints them.
+"""
+import copy
+import sys
+from collections import OrderedDict
+from xml.etree import ElementTree
+
+from cache import FIELD, forget_udfs, udf_map
+
+__author__ = 'rf9'
+
+
+def same_value(current, value):
+    if current == value:
+        return True
+    try:
+        return current is not None and float(current) == float(value)
+    except ValueError:
+        return False
+
+
+def set_udf(xml, name, value, field_type='String'):
+    fields = udf_map(xml).get(name)
+    if fields:
+        fields[0].text = value
+    else:
+        element = ElementTree.Element(FIELD, {'type': field_type, 'name': name})
+        element.text = value
+        xml.append(element)
+    forget_udfs(xml)
+
+
+class UdfUpdater:
+    def __init__(self, clarity, object_type, dry_run=False, flush_size=None, field_type='String'):
+        self.clarity = clarity
+        self.object_type = object_type
+        self.dry_run = dry_run
+        self.flush_size = flush_size or clarity.batch_size * clarity.max_workers
+        self.field_type = field_type
+
+        self._pending = OrderedDict()
+        # (uri, name, old value, new value) for every value changed.
+        self.changes = []
+        self.unchanged = 0
+        self.objects = 0
+        self.requests = 0
+
+    def update(self, xml, values):
+        # Set the UDFs in values (a dictionary of name to text) on the object xml (or its uri) at the next flush.
+        uri = xml if isinstance(xml, str) else xml.get('uri')
+        self._pending.setdefault(uri, OrderedDict()).update(values)
+        if len(self._pending) >= self.flush_size:
+            self.flush()
+
+    def flush(self):
+        pending = OrderedDict(self._pending)
+        self._pending.clear()
+        if not pending:
+            return
+
+        xml_list = []
+        for uri, element in self.clarity.get_xml_map(pending, use_cache=False).items():
+            # The downloaded objects are cached, so leave them untouched until the server has the new versions.
+            element = copy.deepcopy(element)
+            changed = False
+            for name, value in pending[uri].items():
+                fields = udf_map(element).get(name)
+                current = fields[0].text if fields else None
+                if same_value(current, value):
+                    self.unchanged += 1
+                else:
+                    set_udf(element, name, value, self.field_type)
+                    self.changes.append((uri, name, current, value))
+                    changed = True
+            if changed:
+                xml_list.append(element)
+        if not xml_list:
+            return
+
+        self.objects += len(xml_list)
+        self.requests += (len(xml_list) + self.clarity.batch_size - 1) // self.clarity.batch_size
+        if not self.dry_run:
+            self.clarity.batch_post_xml(self.object_type, xml_list)
+
+    def report(self, file=sys.stdout):
+        if self.dry_run:
+            for uri, name, current, value in self.changes:
+                print('%s %s: %r -> %r' % (uri, name, current, value), file=file)
+
+        print('%s %d values on %d %s (%d already set) in %d batch update requests' % (
+            'Would change' if self.dry_run else 'Changed', len(self.changes), self.objects, self.object_type,
+            self.unchanged, self.requests), file=file)